@@ -1,13 +1,24 @@
 import streamlit as st
 import pandas as pd
-import json
+import io
+import orjson
 import os
-from dataclasses import dataclass
-from typing import List
+import ast
+import hashlib
+import functools
+import threading
+import time
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from openai import OpenAI
-import plotly.graph_objects as go
-import plotly.express as px
-from simple_kg_helper import SimpleKGHelper
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+from simple_kg_helper import get_kg_helper, category_matcher, question_template
+from semantic_cache import SemanticCache, embed_text
+from sandbox import run_generated
+from prompts import (
+    SYSTEM_CONTEXT_PYTHON, CONTEXT_RESPONSE_SCHEMA, PROMPT_OUTPUT,
+    build_context_prompt, build_local_info, compute_aggregates
+)
 
 # Get API Key from Streamlit Secrets (secure method)
 try:
@@ -19,7 +30,27 @@ except:
         st.error("⚠️ OpenAI API key not found. Please configure it in Streamlit secrets.")
         st.stop()
 
-client = OpenAI(api_key=OPENAI_API_KEY)
+@st.cache_resource(show_spinner=False)
+def get_openai_client(api_key: str) -> OpenAI:
+    """Create the OpenAI client once per API key and reuse it across reruns"""
+    return OpenAI(api_key=api_key)
+
+client = get_openai_client(OPENAI_API_KEY)
+
+@st.cache_resource(show_spinner=False)
+def get_executor() -> ThreadPoolExecutor:
+    """Shared worker pool for network-bound calls"""
+    return ThreadPoolExecutor(max_workers=4, thread_name_prefix="app-worker")
+
+def submit_with_context(fn, *args, **kwargs):
+    """Run fn in the worker pool with the current Streamlit script context attached"""
+    ctx = get_script_run_ctx()
+    
+    def call():
+        add_script_run_ctx(threading.current_thread(), ctx)
+        return fn(*args, **kwargs)
+    
+    return get_executor().submit(call)
 
 # Page configuration
 st.set_page_config(
@@ -38,179 +69,78 @@ if 'transaction_list' not in st.session_state:
 if 'local_info' not in st.session_state:
     st.session_state.local_info = None
 
-# Transaction class
-@dataclass
-class Transaction:
-    date: str
-    account: str
-    category: str
-    merchant: str
-    transaction_type: str
-    currency: str
-    amount: float
-    amount_uc: float
-
-# Prompts
-PROMPT_CONTEXT_PYTHON = """
-*Introduction*
-We handle personal financial transactions, helping users analyze and gain insights from their data.
-
-Each transaction is a Python dataclass with these attributes (use DOT notation to access):
-- transaction.date (string, YYYY-MM-DD): Transaction date
-- transaction.account (string): Account identifier (User ID)
-- transaction.category (string): User-defined transaction type (e.g., 'Food', 'Leisure')
-- transaction.merchant (string): Merchant name (e.g., 'AMAZON', 'APPLE')
-- transaction.transaction_type (string): Either 'income' or 'outcome'
-- transaction.currency (string): Currency code (e.g., 'USD', 'EUR', 'GBP')
-- transaction.amount (float): Amount in original currency (non-negative)
-- transaction.amount_uc (float): Amount in user's default currency (non-negative)
-
-CRITICAL: Access attributes using DOT notation: transaction.date, transaction.amount
-NEVER use bracket notation: transaction['date'] will cause errors!
-
-IMPORTANT: Filter transactions by current user ID: {current_user_id}
-Always filter: user_transactions = [t for t in transaction_list if t.account == '{current_user_id}']
-
-Example correct code:
-```python
-def get_context(transaction_list):
-    import datetime
-    # Filter by current user
-    user_transactions = [t for t in transaction_list if t.account == '{current_user_id}']
+# On-disk caches for parsed datasets and answered questions
+DATASET_CACHE_DIR = os.path.join('.cache', 'datasets')
+DATASET_CACHE_VERSION = 2  # bump when the parsed dtypes change
+RESPONSE_CACHE_DIR = os.path.join('.cache', 'responses')
+RESPONSE_CACHE_TTL = 86400  # seconds before a cached answer is recomputed
+RESPONSE_CACHE_MAX_FILES = 1000  # oldest answers are pruned beyond this
+
+# Limits for executing generated code
+GENERATED_CODE_TIMEOUT = 5  # seconds
+ALLOWED_IMPORTS = {'pandas', 'numpy', 'datetime', 'numba', 'plotly', 'math', 'collections'}
+FORBIDDEN_CALLS = {'eval', 'exec', 'open', '__import__', 'compile'}
+
+# Column dtypes for the transactions CSV (string columns are dictionary-encoded)
+TRANSACTION_DTYPES = {
+    'account': 'category',
+    'category': 'category',
+    'merchant': 'category',
+    'currency': 'category',
+    'transaction_type': 'category',
+}
+
+def dataset_fingerprint(file_bytes: bytes) -> str:
+    """Content hash of the raw dataset, used to key the Parquet and response caches"""
+    return f"{hashlib.md5(file_bytes).hexdigest()}-v{DATASET_CACHE_VERSION}"
+
+@st.cache_data(show_spinner=False)
+def load_transactions(file_bytes: bytes) -> pd.DataFrame:
+    """Parse transactions CSV content (cached by file content)"""
+    parquet_path = os.path.join(DATASET_CACHE_DIR, f"{dataset_fingerprint(file_bytes)}.parquet")
+    if os.path.exists(parquet_path):
+        return pd.read_parquet(parquet_path, engine='pyarrow', use_threads=True)
     
-    total = 0
-    for transaction in user_transactions:
-        if transaction.transaction_type == 'outcome':
-            total += transaction.amount_uc
-    return {{'total': total}}
-```
-
-*Task*
-Generate a response in JSON format with these keys:
-
-1. "is_relevant": (Boolean) True if query is about financial transactions, False otherwise.
-2. "needs_diagram": (Boolean) True if query requires visualization (comparisons, trends over time).
-3. "context_code": (String) Python function named `get_context` that processes transaction_list.
-   - MUST filter by user ID first: [t for t in transaction_list if t.account == '{current_user_id}']
-   - Must use DOT notation to access transaction attributes
-   - Returns a dictionary with necessary context for answering AND for plotting
-   - For plots, include data as lists: {{'labels': ['Dec', 'Jan'], 'values': [1000, 800]}}
-4. "algorithm_explanation": (String) High-level explanation in '{user_language}'.
-5. "diagram_code": (String) ONLY if needs_diagram is True. Python function named `plot` that:
-   - Takes context dictionary as parameter
-   - Uses ONLY plotly.express (import as px) or plotly.graph_objects (import as go)
-   - NEVER use matplotlib or seaborn
-   - Creates and returns a plotly figure object
-   - Common chart types:
-     * Bar chart: px.bar(x=context['labels'], y=context['values'], title='Title')
-     * Line chart: px.line(x=context['dates'], y=context['amounts'], title='Title')
-     * Pie chart: px.pie(values=context['values'], names=context['labels'], title='Title')
-   - Example bar chart:
-   ```python
-   def plot(context):
-       import plotly.express as px
-       fig = px.bar(
-           x=context['labels'], 
-           y=context['values'],
-           title='Spending Comparison',
-           labels={{'x': 'Month', 'y': 'Amount'}}
-       )
-       return fig
-   ```
-   - Example with graph_objects:
-   ```python
-   def plot(context):
-       import plotly.graph_objects as go
-       fig = go.Figure(data=[
-           go.Bar(x=context['labels'], y=context['values'], marker_color='lightblue')
-       ])
-       fig.update_layout(
-           title='Spending by Category',
-           xaxis_title='Category',
-           yaxis_title='Amount',
-           template='plotly_white'
-       )
-       return fig
-   ```
-
-*Input Context*:
-  * Current User ID: {current_user_id}
-  * Current date: {latest_date}
-  * Date range: {start_date} to {latest_date}
-  * User's default currency: '{currency}'
-  * User's default language: '{user_language}'
-  * User's Categories: {unique_categories}
-  * User's Currencies: {unique_currencies}
-
-Query: {question}
-
-*CRITICAL Requirements*:
-- ALWAYS filter by user ID first in get_context function
-- Use DOT notation: transaction.date, transaction.amount_uc, etc.
-- For plotting: ONLY use plotly.express or plotly.graph_objects
-- NEVER import or use matplotlib, seaborn, or pyplot
-- Import only: datetime, plotly.express as px, plotly.graph_objects as go (if needed)
-- Function names must be exactly: get_context and plot
-- The plot function MUST return a plotly figure object
-- If query is irrelevant or dates out of range, return:
-  {{"is_relevant": false,"needs_diagram": false,"context_code": "","algorithm_explanation":"","diagram_code": ""}}
-
-Return valid JSON string. Remember: Use ONLY Plotly for charts, NEVER matplotlib!
-"""
-
-PROMPT_OUTPUT = """
-**Task**: You are an expert data analyst. You are given the following context to answer the given question.
-
-**Context**:
-{context}
-
-**Question**
-{question}
-
-**Additional Information**:
-  * Country code of the user: '{user_country}'
-  * Default language code of the user: '{user_language}'. Provide your response in user's default language.
-  * Default currency code of the user: '{currency}'. If no currency information given assume the default currency.
-  * Format monetary values with two decimal places. Remove trailing zeros.
-  * Use appropriate formatting for the currency, e.g. $10.65, £12.34, 50.25₾ etc.
-  * If context is empty, respond with "We don't have such information" in appropriate language.
-  * Only provide the answer. Do not include the question.
-
-**Format and Tone**:
-  * Provide clear and concise answers.
-  * Use a friendly and professional tone.
-  * Provide the final output only.
-"""
+    # pyarrow's multithreaded CSV reader parses and converts columns in C++
+    df = pd.read_csv(io.BytesIO(file_bytes), engine='pyarrow', dtype=TRANSACTION_DTYPES, parse_dates=['date'])
+    for column in ('amount', 'amount_uc'):
+        df[column] = pd.to_numeric(df[column], downcast='float')
+    try:
+        os.makedirs(DATASET_CACHE_DIR, exist_ok=True)
+        df.to_parquet(parquet_path, engine='pyarrow', compression='zstd', index=False)
+    except (ImportError, OSError) as e:
+        st.warning(f"Could not cache dataset as Parquet: {e}")
+    return df
 
 def load_baseline_dataset():
-    """Load the baseline transaction dataset"""
+    """Load the baseline transaction dataset and its content fingerprint"""
     try:
         # Try to load from file
-        df = pd.read_csv('test_input.csv')
-        return df
+        with open('test_input.csv', 'rb') as f:
+            file_bytes = f.read()
+        return load_transactions(file_bytes), dataset_fingerprint(file_bytes)
     except FileNotFoundError:
         st.error("❌ Baseline dataset 'test_input.csv' not found. Please ensure the file is in the same directory as the app.")
-        return None
+        return None, None
 
-def df_to_transaction_list(df: pd.DataFrame) -> List[Transaction]:
-    """Convert DataFrame to list of Transaction objects"""
-    transactions = []
-    for _, row in df.iterrows():
-        transaction = Transaction(
-            date=str(row['date']),
-            account=str(row['account']),
-            category=str(row['category']),
-            merchant=str(row['merchant']),
-            transaction_type=str(row['transaction_type']),
-            currency=str(row['currency']),
-            amount=float(row['amount']),
-            amount_uc=float(row['amount_uc'])
-        )
-        transactions.append(transaction)
-    return transactions
+class StreamInterrupted(Exception):
+    """A streamed answer broke off; the text so far is incomplete"""
+
+def stream_text(completion):
+    """Yield the text deltas of a streamed chat completion"""
+    try:
+        for chunk in completion:
+            if chunk.choices:
+                yield chunk.choices[0].delta.content or ""
+    except Exception as e:
+        st.error(f"API Error: {str(e)}")
+        # Raised so callers don't mistake the partial text for a full answer
+        raise StreamInterrupted(str(e)) from e
 
-def run_prompt(prompt, system_message, output_format):
-    """Call OpenAI API"""
+def run_prompt(prompt, system_message, output_format, response_schema=None, cache_key=None):
+    """Call OpenAI API (text output is returned as a stream of chunks)"""
+    # Requests sharing a cache key are routed together so the static system prefix stays cached
+    extra_body = {"prompt_cache_key": cache_key} if cache_key else None
     try:
         if output_format == 'text':
             completion = client.chat.completions.create(
@@ -220,9 +150,16 @@ def run_prompt(prompt, system_message, output_format):
                     {"role": "user", "content": prompt}
                 ],
                 temperature=0,
-                max_tokens=2048,
+                max_tokens=512,
+                stream=True,
+                extra_body=extra_body,
             )
+            return stream_text(completion)
         else:  # json
+            if response_schema:
+                response_format = {"type": "json_schema", "json_schema": response_schema}
+            else:
+                response_format = {"type": "json_object"}
             completion = client.chat.completions.create(
                 model="gpt-4o-mini",
                 messages=[
@@ -230,44 +167,86 @@ def run_prompt(prompt, system_message, output_format):
                     {"role": "user", "content": prompt}
                 ],
                 temperature=0,
-                max_tokens=2048,
-                response_format={"type": "json_object"}
+                max_tokens=1024,
+                response_format=response_format,
+                extra_body=extra_body
             )
         return completion.choices[0].message.content.strip()
     except Exception as e:
         st.error(f"API Error: {str(e)}")
         return None
 
-def process_question(question, transaction_list, local_info, current_user_id):
+def validate_generated_code(tree):
+    """Reject generated code with disallowed imports, calls or unbounded loops"""
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            modules = [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom):
+            modules = [node.module or '']
+        else:
+            modules = []
+        for module in modules:
+            if module.split('.')[0] not in ALLOWED_IMPORTS:
+                raise ValueError(f"Import of '{module}' is not allowed in generated code")
+        
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in FORBIDDEN_CALLS:
+            raise ValueError(f"Call to '{node.func.id}' is not allowed in generated code")
+        if isinstance(node, ast.While):
+            raise ValueError("while loops are not allowed in generated code")
+
+@functools.lru_cache(maxsize=256)
+def check_generated_code(code):
+    """Parse and validate generated code once per distinct source"""
+    validate_generated_code(ast.parse(code, '<generated>'))
+
+def call_generated(code, function_name, argument, **namespace_extra):
+    """Run a generated function in a child process, killed after GENERATED_CODE_TIMEOUT"""
+    check_generated_code(code)
+    return run_generated(code, function_name, argument, GENERATED_CODE_TIMEOUT, **namespace_extra)
+
+def shrink_context(value, max_items=50):
+    """Reduce a generated context to a compact, JSON-friendly structure"""
+    if isinstance(value, pd.DataFrame):
+        return shrink_context(value.head(max_items).to_dict(orient='records'), max_items)
+    if isinstance(value, pd.Series):
+        return shrink_context(value.head(max_items).to_dict(), max_items)
+    if isinstance(value, np.ndarray):
+        return shrink_context(value[:max_items].tolist(), max_items)
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, dict):
+        return {str(k): shrink_context(v, max_items) for k, v in list(value.items())[:max_items]}
+    if isinstance(value, (list, tuple, set)):
+        return [shrink_context(v, max_items) for v in list(value)[:max_items]]
+    if isinstance(value, float):
+        return round(value, 2)
+    return value
+
+def serialize_context(context):
+    """Compact JSON encoding of the context for the output prompt"""
+    return orjson.dumps(
+        context, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY, default=str
+    ).decode()
+
+def process_question(question, user_transactions, local_info, current_user_id, aggregates):
     """Process user question and generate response"""
     
-    # Filter transactions for current user only
-    user_transactions = [t for t in transaction_list if t.account == current_user_id]
-    
-    if not user_transactions:
+    # user_transactions is the current user's slice, filtered once at login
+    if user_transactions.empty:
         return f"No transactions found for user ID: {current_user_id}", None, None
     
-    # Extract metadata from user's transactions only
-    unique_categories = str(set(t.category for t in user_transactions))
-    unique_currencies = str(set(t.currency for t in user_transactions))
+    # Generate code (local_info carries the user's categories and currencies)
+    full_prompt = build_context_prompt(question, current_user_id, local_info, aggregates)
     
-    # Generate code
-    system_message = "You are a helpful assistant that generates Python code for financial data analysis."
-    full_prompt = PROMPT_CONTEXT_PYTHON.format(
-        question=question,
-        current_user_id=current_user_id,
-        unique_categories=unique_categories,
-        unique_currencies=unique_currencies,
-        **local_info
+    code_response = run_prompt(
+        full_prompt, SYSTEM_CONTEXT_PYTHON, 'json', CONTEXT_RESPONSE_SCHEMA, cache_key="context-python"
     )
-    
-    code_response = run_prompt(full_prompt, system_message, 'json')
     if not code_response:
         return None, None, None
     
     try:
-        code_dict = json.loads(code_response)
-    except json.JSONDecodeError as e:
+        code_dict = orjson.loads(code_response)
+    except orjson.JSONDecodeError as e:
         st.error(f"Failed to parse code response: {e}")
         return None, None, None
     
@@ -275,40 +254,309 @@ def process_question(question, transaction_list, local_info, current_user_id):
     if not code_dict.get('is_relevant', False):
         return "Sorry, I can only answer questions about your financial transactions.", None, None
     
+    # Answered from the precomputed spending summary: skip code execution and the output prompt
+    if code_dict.get('direct_answer') and not code_dict.get('needs_diagram', False):
+        return code_dict['direct_answer'], None, None
+    
     # Execute generated code
     context = {}
     try:
-        exec(code_dict['context_code'], globals())
-        context = get_context(transaction_list)
+        context = call_generated(
+            code_dict['context_code'], 'get_context', user_transactions, aggregates=aggregates
+        )
     except Exception as e:
         st.error(f"Error executing generated code: {str(e)}")
         with st.expander("🐛 See generated code"):
             st.code(code_dict['context_code'])
         return None, None, None
     
-    # Generate natural language output
+    # Generate natural language output from a compact copy of the context;
+    # the plot function still receives the full context
+    plot_context = context
+    context = shrink_context(context)
     system_message = "You are a helpful financial assistant."
     output_prompt = PROMPT_OUTPUT.format(
         question=question,
-        context=context,
+        context=serialize_context(context),
         **local_info
     )
     
-    output = run_prompt(output_prompt, system_message, 'text')
+    # Start the output prompt and build the diagram while it is in flight
+    output_future = submit_with_context(run_prompt, output_prompt, system_message, 'text')
     
     # Handle diagram if needed
     fig = None
     if code_dict.get('needs_diagram', False) and code_dict.get('diagram_code'):
         try:
-            exec(code_dict['diagram_code'], globals())
-            fig = plot(context)
+            fig = call_generated(code_dict['diagram_code'], 'plot', plot_context, plotly=True)
         except Exception as e:
             st.warning(f"Could not generate diagram: {str(e)}")
             with st.expander("🐛 See diagram code"):
                 st.code(code_dict.get('diagram_code', 'No code generated'))
     
+    output = output_future.result()
     return output, context, fig
 
+def response_cache_key(question, data_fingerprint, local_info, current_user_id):
+    """Build the response cache key from the normalized question and its inputs"""
+    payload = orjson.dumps(
+        [question.lower().strip(), data_fingerprint, current_user_id, local_info],
+        option=orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS, default=str
+    )
+    return hashlib.md5(payload).hexdigest()
+
+def load_cached_response(key):
+    """Return a cached (output, context, fig) triple, or None on a miss or an expired entry"""
+    path = os.path.join(RESPONSE_CACHE_DIR, f"{key}.json")
+    try:
+        with open(path, 'rb') as f:
+            entry = orjson.loads(f.read())
+    except (OSError, ValueError):
+        return None
+    if time.time() - entry.get('created', 0) > RESPONSE_CACHE_TTL:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        return None
+    fig = None
+    if entry.get('figure'):
+        import plotly.io as pio
+        fig = pio.from_json(entry['figure'])
+    return entry['output'], entry.get('context'), fig
+
+def prune_response_cache():
+    """Delete expired answers and, beyond RESPONSE_CACHE_MAX_FILES, the oldest ones"""
+    now = time.time()
+    files = []
+    with os.scandir(RESPONSE_CACHE_DIR) as entries:
+        for entry in entries:
+            try:
+                files.append((entry.stat().st_mtime, entry.path))
+            except OSError:
+                pass  # removed by another session meanwhile
+    files.sort()
+    excess = len(files) - RESPONSE_CACHE_MAX_FILES
+    for index, (modified, path) in enumerate(files):
+        if index >= excess and now - modified <= RESPONSE_CACHE_TTL:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+def save_cached_response(key, output, context, fig):
+    """Persist an answer so identical questions skip the OpenAI calls for RESPONSE_CACHE_TTL"""
+    entry = {
+        'output': output,
+        'context': context,
+        'figure': fig.to_json() if fig else None,
+        'created': time.time()
+    }
+    try:
+        os.makedirs(RESPONSE_CACHE_DIR, exist_ok=True)
+        with open(os.path.join(RESPONSE_CACHE_DIR, f"{key}.json"), 'wb') as f:
+            f.write(orjson.dumps(entry, default=str))
+        prune_response_cache()
+    except (OSError, TypeError, ValueError) as e:
+        st.warning(f"Could not cache response: {e}")
+
+def cache_on_completion(stream, store):
+    """Pass a streamed answer through and store the full text once it completes.
+    
+    A StreamInterrupted from the stream propagates before anything is stored.
+    """
+    chunks = []
+    for chunk in stream:
+        chunks.append(chunk)
+        yield chunk
+    output = "".join(chunks)
+    if output:
+        store(output)
+
+def question_embedding(question):
+    """Embedding of the normalized question, or None if the embeddings call fails"""
+    try:
+        return embed_text(client, question.lower().strip())
+    except Exception:
+        return None
+
+SEMANTIC_CACHE_THRESHOLD = 0.95
+
+@functools.lru_cache(maxsize=16)
+def dataset_category_matcher(names):
+    """Category matcher for a dataset's category names (a tuple)"""
+    return category_matcher(names)
+
+def question_slots(question, user_transactions):
+    """Categories, months and numbers in a question; similar answers are only reused when they match"""
+    names = tuple(user_transactions['category'].cat.categories)
+    return question_template(question, *dataset_category_matcher(names))[1]
+
+@st.cache_resource
+def get_semantic_caches():
+    """Process-wide semantic caches shared by all sessions, keyed by user, dataset and locale"""
+    return {}, threading.Lock()
+
+def user_semantic_cache(user_id, data_fingerprint, local_info):
+    """Semantic cache for one user's answers on one dataset version and locale.
+    
+    Look up and add with question_slots, so only paraphrases with the same
+    numbers, months and categories share an answer.
+    """
+    caches, lock = get_semantic_caches()
+    with lock:
+        # Answers are phrased in the user's language and currency
+        key = (
+            user_id, data_fingerprint,
+            local_info['user_language'], local_info['currency'], local_info['user_country']
+        )
+        if key not in caches:
+            caches[key] = SemanticCache(threshold=SEMANTIC_CACHE_THRESHOLD)
+        return caches[key]
+
+def render_response(response):
+    """Render a plain or streamed answer and return its full text"""
+    if isinstance(response, str):
+        st.markdown(response)
+        return response
+    
+    chunks = []
+    
+    def collect():
+        try:
+            for chunk in response:
+                chunks.append(chunk)
+                yield chunk
+        except StreamInterrupted:
+            pass  # already reported; keep the partial text on screen
+    
+    st.write_stream(collect())
+    return "".join(chunks)
+
+def process_question_cached(question, user_transactions, local_info, current_user_id, aggregates, data_fingerprint):
+    """Answer from the response caches when possible, otherwise run process_question"""
+    key = response_cache_key(question, data_fingerprint, local_info, current_user_id)
+    cached = load_cached_response(key)
+    if cached:
+        st.caption("⚡ Answer served from cache")
+        return cached
+    
+    # Fall back to the answer of a similarly phrased earlier question with the
+    # same numbers, months and categories ("top 5" and "top 10" embed alike)
+    qa_cache = user_semantic_cache(current_user_id, data_fingerprint, local_info)
+    slots = question_slots(question, user_transactions)
+    embedding = question_embedding(question)
+    if embedding is not None:
+        similar = qa_cache.lookup(embedding, slots)
+        if similar:
+            st.caption("⚡ Answer served from cache (similar question)")
+            return similar
+    
+    output, context, fig = process_question(question, user_transactions, local_info, current_user_id, aggregates)
+    
+    def store(text):
+        save_cached_response(key, text, context, fig)
+        if embedding is not None:
+            qa_cache.add(embedding, (text, context, fig), slots)
+    
+    if isinstance(output, str):
+        store(output)
+    elif output:
+        output = cache_on_completion(output, store)
+    return output, context, fig
+
+@st.fragment
+def chat_interface():
+    """Chat history and input, rerun on their own when a message is sent"""
+    for message in st.session_state.messages:
+        with st.chat_message(message["role"]):
+            st.markdown(message["content"])
+            if "context" in message and message["context"]:
+                with st.expander("📊 See context data"):
+                    st.json(message["context"])
+            if message.get("figure_json"):
+                import plotly.io as pio
+                st.plotly_chart(pio.from_json(message["figure_json"]), use_container_width=True)
+    
+    # Chat input
+    if prompt := st.chat_input("Ask about your transactions..."):
+        # Add user message
+        st.session_state.messages.append({"role": "user", "content": prompt})
+        with st.chat_message("user"):
+            st.markdown(prompt)
+        
+        # Generate response
+        with st.chat_message("assistant"):
+            with st.spinner("Analyzing your transactions..."):
+                # Smart routing: KG for complex, simple for basic. Unless keywords
+                # already rule the KG out, its calls start speculatively so they
+                # overlap with the routing call
+                prefetched = None
+                if st.session_state.kg and st.session_state.kg.keyword_route(prompt) is not False:
+                    prefetched = st.session_state.kg.prefetch(
+                        prompt, st.session_state.local_info['currency']
+                    )
+                
+                if st.session_state.kg and st.session_state.kg.should_use_kg(prompt, prefetched):
+                    st.caption("🔍 Using Knowledge Graph")
+                    
+                    kg_data = st.session_state.kg.query_kg(
+                        question=prompt,
+                        user_id=st.session_state.user_id,
+                        currency=st.session_state.local_info['currency'],
+                        prefetched=prefetched
+                    )
+                    
+                    if kg_data:
+                        response = st.session_state.kg.format_kg_results(
+                            kg_data, prompt,
+                            st.session_state.local_info['user_language'],
+                            st.session_state.local_info['currency']
+                        )
+                        context = kg_data
+                        fig = None
+                        
+                        with st.expander("🔧 See Cypher Query"):
+                            st.code(kg_data['cypher'], language='cypher')
+                    else:
+                        st.caption("🔄 Falling back to in-memory")
+                        response, context, fig = process_question_cached(
+                            prompt, st.session_state.user_transactions,
+                            st.session_state.local_info, st.session_state.user_id,
+                            st.session_state.aggregates, st.session_state.data_fingerprint
+                        )
+                else:
+                    st.caption("🔍 Using In-Memory Processing")
+                    response, context, fig = process_question_cached(
+                        prompt, st.session_state.user_transactions,
+                        st.session_state.local_info, st.session_state.user_id,
+                        st.session_state.aggregates, st.session_state.data_fingerprint
+                    )
+                
+                if response:
+                    response = render_response(response)
+                    
+                    # Show context in expander
+                    if context:
+                        with st.expander("📊 See context data"):
+                            st.json(context)
+                    
+                    # Show diagram if available
+                    if fig:
+                        st.plotly_chart(fig, use_container_width=True)
+                    
+                    # Save to chat history
+                    st.session_state.messages.append({
+                        "role": "assistant",
+                        "content": response,
+                        "context": context,
+                        # The JSON spec is much smaller to keep in session state than the Figure
+                        "figure_json": fig.to_json() if fig else None
+                    })
+                else:
+                    st.error("Failed to generate response. Please try again.")
+
 # Authentication/Setup Page
 if not st.session_state.authenticated:
     st.title("💰 Financial AI Assistant")
@@ -347,29 +595,21 @@ if not st.session_state.authenticated:
             if user_id:
                 # Load baseline dataset
                 with st.spinner("Loading transaction data..."):
-                    df = load_baseline_dataset()
+                    df, data_fingerprint = load_baseline_dataset()
                     
                     if df is not None:
-                        st.session_state.transaction_list = df_to_transaction_list(df)
+                        st.session_state.transaction_list = df
+                        st.session_state.data_fingerprint = data_fingerprint
                         
                         # Check if user exists in dataset
-                        user_transactions = [t for t in st.session_state.transaction_list if t.account == user_id]
+                        user_transactions = df[df['account'] == user_id]
                         
-                        if not user_transactions:
+                        if user_transactions.empty:
                             st.error(f"❌ User ID '{user_id}' not found in the dataset. Please check your ID.")
                         else:
-                            # Extract date range from user's transactions
-                            dates = [t.date for t in user_transactions]
-                            start_date = min(dates)
-                            latest_date = max(dates)
-                            
-                            st.session_state.local_info = {
-                                'user_language': language,
-                                'user_country': country,
-                                'currency': currency,
-                                'start_date': start_date,
-                                'latest_date': latest_date
-                            }
+                            st.session_state.local_info = build_local_info(user_transactions, language, country, currency)
+                            st.session_state.user_transactions = user_transactions
+                            st.session_state.aggregates = compute_aggregates(user_transactions)
                             st.session_state.user_id = user_id
                             st.session_state.authenticated = True
                             st.rerun()
@@ -379,11 +619,21 @@ if not st.session_state.authenticated:
 # Initialize KG helper
 if 'kg' not in st.session_state:
     try:
-        st.session_state.kg = SimpleKGHelper(
+        # Optional [formatter] secrets: base_url, model and api_key of a cheaper model
+        formatter = st.secrets.get("formatter", {})
+        st.session_state.kg = get_kg_helper(
             uri=st.secrets["neo4j"]["uri"],
             user=st.secrets["neo4j"]["username"],
             password=st.secrets["neo4j"]["password"],
-            openai_client=client
+            openai_api_key=OPENAI_API_KEY,
+            database=st.secrets["neo4j"].get("database", "neo4j"),
+            formatter_base_url=formatter.get("base_url"),
+            formatter_model=formatter.get("model"),
+            formatter_api_key=formatter.get("api_key"),
+            # KG status messages in the chat are for debugging only
+            verbose=bool(st.secrets.get("kg_debug", False)),
+            # Set once migrate_amounts.py has stored the amounts as floats
+            numeric_amounts=bool(st.secrets["neo4j"].get("numeric_amounts", False))
         )
         st.success("✅ Knowledge Graph ready")
     except Exception as e:
@@ -405,86 +655,12 @@ else:
             st.rerun()
     
     # Display transaction info
-    user_transactions = [t for t in st.session_state.transaction_list if t.account == st.session_state.user_id]
-    st.info(f"📊 Loaded {len(user_transactions)} transactions | 📅 {st.session_state.local_info['start_date']} to {st.session_state.local_info['latest_date']} | 💱 {st.session_state.local_info['currency']}")
+    st.info(f"📊 Loaded {len(st.session_state.user_transactions)} transactions | 📅 {st.session_state.local_info['start_date']} to {st.session_state.local_info['latest_date']} | 💱 {st.session_state.local_info['currency']}")
     
     st.divider()
     
     # Chat interface
-    for message in st.session_state.messages:
-        with st.chat_message(message["role"]):
-            st.markdown(message["content"])
-            if "context" in message and message["context"]:
-                with st.expander("📊 See context data"):
-                    st.json(message["context"])
-            if "figure" in message and message["figure"]:
-                st.plotly_chart(message["figure"], use_container_width=True)
-    
-    # Chat input
-    if prompt := st.chat_input("Ask about your transactions..."):
-        # Add user message
-        st.session_state.messages.append({"role": "user", "content": prompt})
-        with st.chat_message("user"):
-            st.markdown(prompt)
-        
-        # Generate response
-        with st.chat_message("assistant"):
-            with st.spinner("Analyzing your transactions..."):
-                # Smart routing: KG for complex, simple for basic
-                if st.session_state.kg and st.session_state.kg.should_use_kg(prompt):
-                    st.caption("🔍 Using Knowledge Graph")
-                    
-                    kg_data = st.session_state.kg.query_kg(
-                        question=prompt,
-                        user_id=st.session_state.user_id,
-                        currency=st.session_state.local_info['currency']
-                    )
-                    
-                    if kg_data:
-                        response = st.session_state.kg.format_kg_results(
-                            kg_data, prompt,
-                            st.session_state.local_info['user_language'],
-                            st.session_state.local_info['currency']
-                        )
-                        context = kg_data
-                        fig = None
-                        
-                        with st.expander("🔧 See Cypher Query"):
-                            st.code(kg_data['cypher'], language='cypher')
-                    else:
-                        st.caption("🔄 Falling back to in-memory")
-                        response, context, fig = process_question(
-                            prompt, st.session_state.transaction_list,
-                            st.session_state.local_info, st.session_state.user_id
-                        )
-                else:
-                    st.caption("🔍 Using In-Memory Processing")
-                    response, context, fig = process_question(
-                        prompt, st.session_state.transaction_list,
-                        st.session_state.local_info, st.session_state.user_id
-                    )
-                
-                if response:
-                    st.markdown(response)
-                    
-                    # Show context in expander
-                    if context:
-                        with st.expander("📊 See context data"):
-                            st.json(context)
-                    
-                    # Show diagram if available
-                    if fig:
-                        st.plotly_chart(fig, use_container_width=True)
-                    
-                    # Save to chat history
-                    st.session_state.messages.append({
-                        "role": "assistant",
-                        "content": response,
-                        "context": context,
-                        "figure": fig
-                    })
-                else:
-                    st.error("Failed to generate response. Please try again.")
+    chat_interface()
 
 # Footer
 st.divider()
@@ -0,0 +1,128 @@
+"""Run the code generation prompt for a set of questions through the OpenAI Batch API.
+
+Intended for offline regression runs against test_input.csv; the Streamlit app
+keeps using real-time calls. Batch requests are billed at a reduced rate.
+
+Usage:
+    python batch_eval.py questions.txt --user-id <id> --output results.jsonl
+"""
+import argparse
+import json
+import os
+import time
+
+import pandas as pd
+from openai import OpenAI
+
+from prompts import (
+    SYSTEM_CONTEXT_PYTHON, CONTEXT_RESPONSE_SCHEMA,
+    build_context_prompt, build_local_info, compute_aggregates
+)
+
+
+def build_requests(questions, user_id, local_info, aggregates):
+    """One Batch API request line per question, keyed by its index"""
+    requests = []
+    for index, question in enumerate(questions):
+        requests.append({
+            "custom_id": f"q-{index}",
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": {
+                "model": "gpt-4o-mini",
+                "messages": [
+                    {"role": "system", "content": SYSTEM_CONTEXT_PYTHON},
+                    {"role": "user", "content": build_context_prompt(question, user_id, local_info, aggregates)}
+                ],
+                "temperature": 0,
+                "max_tokens": 1024,
+                "response_format": {"type": "json_schema", "json_schema": CONTEXT_RESPONSE_SCHEMA}
+            }
+        })
+    return requests
+
+
+def submit_batch(client, requests, requests_path):
+    """Write the requests as JSONL, upload them and start a batch"""
+    with open(requests_path, 'w', encoding='utf-8') as f:
+        for request in requests:
+            f.write(json.dumps(request, ensure_ascii=False) + "\n")
+
+    with open(requests_path, 'rb') as f:
+        batch_file = client.files.create(file=f, purpose="batch")
+    return client.batches.create(
+        input_file_id=batch_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h"
+    )
+
+
+def wait_for_batch(client, batch_id, poll_interval):
+    """Poll until the batch reaches a terminal state"""
+    while True:
+        batch = client.batches.retrieve(batch_id)
+        if batch.status in ("completed", "failed", "expired", "cancelled"):
+            return batch
+        print(f"Batch {batch_id}: {batch.status}")
+        time.sleep(poll_interval)
+
+
+def download_results(client, batch):
+    """Map custom_id to the generated message content (or error)"""
+    results = {}
+    if not batch.output_file_id:
+        return results
+
+    content = client.files.content(batch.output_file_id).text
+    for line in content.splitlines():
+        if not line.strip():
+            continue
+        item = json.loads(line)
+        response = item.get("response") or {}
+        if response.get("status_code") == 200:
+            results[item["custom_id"]] = response["body"]["choices"][0]["message"]["content"]
+        else:
+            results[item["custom_id"]] = {"error": item.get("error") or response}
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("questions", help="Text file with one question per line")
+    parser.add_argument("--user-id", required=True)
+    parser.add_argument("--dataset", default="test_input.csv")
+    parser.add_argument("--language", default="ENG")
+    parser.add_argument("--country", default="USA")
+    parser.add_argument("--currency", default="USD")
+    parser.add_argument("--output", default="batch_results.jsonl")
+    parser.add_argument("--poll-interval", type=int, default=30, help="Seconds between status checks")
+    args = parser.parse_args()
+
+    with open(args.questions, encoding='utf-8') as f:
+        questions = [line.strip() for line in f if line.strip()]
+
+    df = pd.read_csv(args.dataset, parse_dates=['date'])
+    user_transactions = df[df['account'] == args.user_id]
+    if user_transactions.empty:
+        raise SystemExit(f"User ID '{args.user_id}' not found in {args.dataset}")
+
+    local_info = build_local_info(user_transactions, args.language, args.country, args.currency)
+    aggregates = compute_aggregates(user_transactions)
+
+    client = OpenAI(api_key=os.environ["OPENAI_API_KEY"])
+    requests = build_requests(questions, args.user_id, local_info, aggregates)
+    batch = submit_batch(client, requests, args.output + ".requests")
+    print(f"Submitted batch {batch.id} with {len(requests)} requests")
+
+    batch = wait_for_batch(client, batch.id, args.poll_interval)
+    results = download_results(client, batch)
+
+    with open(args.output, 'w', encoding='utf-8') as f:
+        for index, question in enumerate(questions):
+            record = {"question": question, "response": results.get(f"q-{index}")}
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+    print(f"Batch {batch.id} {batch.status}: {len(results)}/{len(questions)} results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+"""Convert Transaction.amount and amount_uc from strings to floats in Neo4j.
+
+One-off migration for graphs loaded with string amounts. It writes in batches
+so a large graph doesn't need one huge transaction, and is safe to re-run:
+transactions whose amounts are already numbers are skipped.
+
+Until the migration has run, the app wraps amounts in toFloat(). Afterwards set
+numeric_amounts = true under [neo4j] in the Streamlit secrets, so queries
+aggregate the float properties directly.
+
+Usage:
+    python migrate_amounts.py --uri neo4j+s://... --user neo4j --password <password>
+"""
+import argparse
+import os
+
+from neo4j import GraphDatabase
+
+
+def migration_query(batch_size):
+    # CALL { ... } IN TRANSACTIONS commits every batch_size rows; it only runs
+    # in an auto-commit transaction (session.run), not in execute_write
+    return (
+        "MATCH (t:Transaction) "
+        "WHERE t.amount = toString(t.amount) OR t.amount_uc = toString(t.amount_uc) "
+        "CALL { WITH t SET t.amount = toFloat(t.amount), t.amount_uc = toFloat(t.amount_uc) } "
+        f"IN TRANSACTIONS OF {int(batch_size)} ROWS"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--uri", default=os.environ.get("NEO4J_URI"))
+    parser.add_argument("--user", default=os.environ.get("NEO4J_USERNAME", "neo4j"))
+    parser.add_argument("--password", default=os.environ.get("NEO4J_PASSWORD"))
+    parser.add_argument("--database", default="neo4j")
+    parser.add_argument("--batch-size", type=int, default=10000)
+    args = parser.parse_args()
+    if not args.uri or not args.password:
+        parser.error("--uri and --password (or NEO4J_URI and NEO4J_PASSWORD) are required")
+
+    with GraphDatabase.driver(args.uri, auth=(args.user, args.password)) as driver:
+        with driver.session(database=args.database) as session:
+            summary = session.run(migration_query(args.batch_size)).consume()
+    print(f"Converted {summary.counters.properties_set} amount properties")
+    print("Now set numeric_amounts = true under [neo4j] in the Streamlit secrets")
+
+
+if __name__ == "__main__":
+    main()
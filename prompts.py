@@ -0,0 +1,221 @@
+import orjson
+
+# Most frequent categories listed in the code generation prompt
+MAX_PROMPT_CATEGORIES = 30
+
+# Static instructions for code generation. Kept free of per-request values so
+# the prefix is byte-identical across calls and eligible for prompt caching.
+SYSTEM_CONTEXT_PYTHON = """You are a helpful assistant that generates Python code for financial data analysis.
+
+*Introduction*
+We handle personal financial transactions, helping users analyze and gain insights from their data.
+
+transaction_list is a pandas DataFrame holding ONLY the current user's transactions (already filtered
+by user ID), one row per transaction, with these columns:
+- date (datetime64): Transaction date
+- account (category): Account identifier (User ID)
+- category (category): User-defined transaction type (e.g., 'Food', 'Leisure')
+- merchant (category): Merchant name (e.g., 'AMAZON', 'APPLE')
+- transaction_type (category): Either 'income' or 'outcome'
+- currency (category): Currency code (e.g., 'USD', 'EUR', 'GBP')
+- amount (float32): Amount in original currency (non-negative)
+- amount_uc (float32): Amount in user's default currency (non-negative)
+
+CRITICAL: Access columns using bracket notation: transaction_list['date'], transaction_list['amount_uc']
+You MUST use vectorized pandas operations (boolean masks, groupby, agg, sum). Do NOT write Python for-loops over rows.
+For custom reductions that pandas cannot express, wrap them in @numba.njit over df['amount_uc'].to_numpy().
+
+A global dict `aggregates` holds precomputed pandas Series of the current user's spending
+(transaction_type 'outcome', summed amount_uc). Use it instead of re-scanning transaction_list when it answers the query:
+- aggregates['by_category']: indexed by category
+- aggregates['by_month']: indexed by month (pandas Period, e.g. 2022-12)
+- aggregates['by_month_category']: indexed by (month, category)
+- aggregates['by_merchant']: indexed by merchant
+The Spending summary in the Input Context shows the top entries of these tables.
+
+IMPORTANT: Do NOT filter by account; transaction_list already contains only the current user's rows.
+
+Example correct code:
+```python
+def get_context(transaction_list):
+    import datetime
+    outcome = transaction_list[transaction_list['transaction_type'] == 'outcome']
+    total = float(outcome['amount_uc'].sum())
+    return {'total': total}
+```
+
+*Task*
+Generate a response in JSON format with these keys:
+
+1. "is_relevant": (Boolean) True if query is about financial transactions, False otherwise.
+2. "needs_diagram": (Boolean) True if query requires visualization (comparisons, trends over time).
+3. "context_code": (String) Python function named `get_context` that processes the transaction_list DataFrame.
+   - Must use bracket notation to access DataFrame columns
+   - Returns a dictionary with necessary context for answering AND for plotting
+   - The dictionary must be JSON-serializable summaries (numbers, strings, lists, dicts), never raw rows or DataFrames
+   - For plots, include data as lists: {'labels': ['Dec', 'Jan'], 'values': [1000, 800]}
+4. "algorithm_explanation": (String) High-level explanation in the user's default language.
+5. "diagram_code": (String) ONLY if needs_diagram is True. Python function named `plot` that:
+   - Takes context dictionary as parameter
+   - Uses ONLY plotly.express (import as px) or plotly.graph_objects (import as go)
+   - NEVER use matplotlib or seaborn
+   - Creates and returns a plotly figure object
+   - Common chart types:
+     * Bar chart: px.bar(x=context['labels'], y=context['values'], title='Title')
+     * Line chart: px.line(x=context['dates'], y=context['amounts'], title='Title')
+     * Pie chart: px.pie(values=context['values'], names=context['labels'], title='Title')
+   - Example bar chart:
+   ```python
+   def plot(context):
+       import plotly.express as px
+       fig = px.bar(
+           x=context['labels'], 
+           y=context['values'],
+           title='Spending Comparison',
+           labels={'x': 'Month', 'y': 'Amount'}
+       )
+       return fig
+   ```
+   - Example with graph_objects:
+   ```python
+   def plot(context):
+       import plotly.graph_objects as go
+       fig = go.Figure(data=[
+           go.Bar(x=context['labels'], y=context['values'], marker_color='lightblue')
+       ])
+       fig.update_layout(
+           title='Spending by Category',
+           xaxis_title='Category',
+           yaxis_title='Amount',
+           template='plotly_white'
+       )
+       return fig
+   ```
+6. "direct_answer": (String) ONLY when needs_diagram is False and the query can be answered exactly from the
+   Spending summary in the Input Context: the final answer for the user, in the user's default language,
+   with monetary values formatted with two decimals and the currency symbol. Otherwise an empty string.
+   When direct_answer is set, context_code may be an empty string.
+
+*CRITICAL Requirements*:
+- transaction_list is already filtered to the current user; do not filter by account
+- Use DataFrame columns: transaction_list['date'], transaction_list['amount_uc'], etc.
+- Use vectorized pandas operations, never Python for-loops over rows
+- For plotting: ONLY use plotly.express or plotly.graph_objects
+- NEVER import or use matplotlib, seaborn, or pyplot
+- Import only: datetime, pandas as pd, numpy as np, numba, plotly.express as px, plotly.graph_objects as go (if needed)
+- Function names must be exactly: get_context and plot
+- The plot function MUST return a plotly figure object
+- If query is irrelevant or dates out of range, return:
+  {"is_relevant": false,"needs_diagram": false,"context_code": "","algorithm_explanation":"","diagram_code": "","direct_answer": ""}
+
+Return valid JSON string. Remember: Use ONLY Plotly for charts, NEVER matplotlib!
+"""
+
+# Structured output schema for the code generation call
+CONTEXT_RESPONSE_SCHEMA = {
+    "name": "transaction_context",
+    "strict": True,
+    "schema": {
+        "type": "object",
+        "properties": {
+            "is_relevant": {"type": "boolean"},
+            "needs_diagram": {"type": "boolean"},
+            "context_code": {"type": "string"},
+            "algorithm_explanation": {"type": "string"},
+            "diagram_code": {"type": "string"},
+            "direct_answer": {"type": "string"}
+        },
+        "required": [
+            "is_relevant", "needs_diagram", "context_code", "algorithm_explanation", "diagram_code", "direct_answer"
+        ],
+        "additionalProperties": False
+    }
+}
+
+# Per-request part of the code generation prompt
+PROMPT_CONTEXT_PYTHON = """
+*Input Context*:
+  * Current User ID: {current_user_id}
+  * Current date: {latest_date}
+  * Date range: {start_date} to {latest_date}
+  * User's default currency: '{currency}'
+  * User's default language: '{user_language}'
+  * User's Categories: {unique_categories}
+  * User's Currencies: {unique_currencies}
+  * Spending summary: {spending_summary}
+
+Query: {question}
+"""
+
+PROMPT_OUTPUT = """
+**Task**: You are an expert data analyst. You are given the following context to answer the given question.
+
+**Context**:
+{context}
+
+**Question**
+{question}
+
+**Additional Information**:
+  * Country code of the user: '{user_country}'
+  * Default language code of the user: '{user_language}'. Provide your response in user's default language.
+  * Default currency code of the user: '{currency}'. If no currency information given assume the default currency.
+  * Format monetary values with two decimal places. Remove trailing zeros.
+  * Use appropriate formatting for the currency, e.g. $10.65, £12.34, 50.25₾ etc.
+  * If context is empty, respond with "We don't have such information" in appropriate language.
+  * Only provide the answer. Do not include the question.
+
+**Format and Tone**:
+  * Provide clear and concise answers.
+  * Use a friendly and professional tone.
+  * Provide the final output only.
+"""
+
+def compute_aggregates(user_transactions):
+    """Precompute the current user's spending group-bys once per session"""
+    spending = user_transactions[user_transactions['transaction_type'] == 'outcome']
+    amounts = spending['amount_uc']
+    months = spending['date'].dt.to_period('M')
+    return {
+        'by_category': amounts.groupby(spending['category'], observed=True).sum().sort_values(ascending=False),
+        'by_month': amounts.groupby(months).sum(),
+        'by_month_category': amounts.groupby([months, spending['category']], observed=True).sum(),
+        'by_merchant': amounts.groupby(spending['merchant'], observed=True).sum().sort_values(ascending=False),
+    }
+
+def summarize_aggregates(aggregates, top_k=10):
+    """Compact JSON summary (top-K per axis) of the precomputed aggregates"""
+    def top(series):
+        return {str(k): round(float(v), 2) for k, v in series.head(top_k).items()}
+    
+    summary = {
+        'by_category': top(aggregates['by_category']),
+        'by_month': {str(k): round(float(v), 2) for k, v in aggregates['by_month'].items()},
+        'by_merchant': top(aggregates['by_merchant']),
+    }
+    return orjson.dumps(summary).decode()
+
+def build_local_info(user_transactions, language, country, currency):
+    """Per-user values for the prompts, computed once from the user's transactions"""
+    # Most frequent categories first, capped to keep the prompt short
+    category_counts = user_transactions['category'].value_counts()
+    top_categories = category_counts[category_counts > 0].head(MAX_PROMPT_CATEGORIES).index.tolist()
+    
+    return {
+        'user_language': language,
+        'user_country': country,
+        'currency': currency,
+        'start_date': user_transactions['date'].min().strftime('%Y-%m-%d'),
+        'latest_date': user_transactions['date'].max().strftime('%Y-%m-%d'),
+        'unique_categories': str(top_categories),
+        'unique_currencies': str(sorted(user_transactions['currency'].unique().tolist()))
+    }
+
+def build_context_prompt(question, current_user_id, local_info, aggregates):
+    """User message for the code generation call"""
+    return PROMPT_CONTEXT_PYTHON.format(
+        question=question,
+        current_user_id=current_user_id,
+        spending_summary=summarize_aggregates(aggregates),
+        **local_info
+    )
@@ -0,0 +1,127 @@
+"""Run generated analysis code in a separate process that can be killed.
+
+Python threads cannot be stopped, so generated code that never finishes would
+keep competing for the GIL with every session for the life of the server. A
+child process is killed once it runs past its time limit.
+
+Where available, children are forked from the server process. Before forking,
+the parent compiles the code and imports the modules it needs (both memoized),
+so the child inherits them and starts in milliseconds. Forking a process with
+running threads (the Streamlit server, HTTP and Neo4j pools) is only safe
+because the child never touches them: it runs the generated code on pandas and
+numpy, sends one result down a pipe and exits. If it inherits a lock that some
+other thread held at fork time and blocks on it, it is killed at the timeout
+like any other runaway.
+
+Without fork (Windows) the forkserver or spawn start method is used instead.
+Those children import this module afresh and compile and import everything
+themselves, which makes every run slower. Under Streamlit they also re-run the
+__main__ module, which is the app script.
+"""
+import datetime
+import functools
+import multiprocessing
+
+import numpy as np
+import pandas as pd
+
+
+@functools.lru_cache(maxsize=256)
+def compile_generated_code(code):
+    """Compile generated code once per distinct source"""
+    return compile(code, '<generated>', 'exec')
+
+
+@functools.cache
+def load_numba():
+    """Import numba on first use; only some generated code needs it"""
+    import numba
+    return numba
+
+
+@functools.cache
+def load_plotly():
+    """Import plotly on first use; it is only needed when a diagram is requested"""
+    import plotly.express as px
+    import plotly.graph_objects as go
+    # The first figure loads plotly's validators and default template; build it
+    # here so forked children inherit them instead of loading them every time
+    px.scatter(x=[0], y=[0])
+    return px, go
+
+
+def generated_code_namespace(code, plotly=False, **extra):
+    """Fresh namespace for executing generated code"""
+    namespace = {'pd': pd, 'np': np, 'datetime': datetime, **extra}
+    if 'numba' in code:
+        namespace['numba'] = load_numba()
+    if plotly:
+        px, go = load_plotly()
+        namespace.update(px=px, go=go)
+    return namespace
+
+
+def _run(connection, code, function_name, argument, plotly, extra):
+    """Child process: execute the code and send back ('ok', result) or ('error', exception)"""
+    try:
+        namespace = generated_code_namespace(code, plotly, **extra)
+        exec(compile_generated_code(code), namespace)
+        message = ('ok', namespace[function_name](argument))
+    except BaseException as e:
+        message = ('error', e)
+    try:
+        connection.send(message)
+    except Exception as e:
+        # The result or the exception could not be pickled
+        connection.send(('error', RuntimeError(f"generated code returned an unsupported value: {e}")))
+    finally:
+        connection.close()
+
+
+@functools.cache
+def get_context():
+    """Multiprocessing context for generated code: fork where the platform has it"""
+    methods = multiprocessing.get_all_start_methods()
+    for method in ('fork', 'forkserver', 'spawn'):
+        if method in methods:
+            return multiprocessing.get_context(method)
+
+
+def run_generated(code, function_name, argument, timeout, plotly=False, **extra):
+    """Call `function_name(argument)` defined by `code` in a child process.
+
+    A forked child inherits the argument; otherwise it is pickled. The result
+    comes back pickled, so it must be picklable (DataFrames and plotly figures
+    are). Raises TimeoutError (after killing the child) if no result arrives
+    within `timeout` seconds, and re-raises any exception of the generated code.
+    """
+    context = get_context()
+    if context.get_start_method() == 'fork':
+        # Warm the caches here so every forked child inherits the code object and modules
+        compile_generated_code(code)
+        generated_code_namespace(code, plotly)
+
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(
+        target=_run,
+        args=(sender, code, function_name, argument, plotly, extra),
+        name="generated-code",
+        daemon=True
+    )
+    process.start()
+    sender.close()
+    try:
+        if not receiver.poll(timeout):
+            raise TimeoutError(f"generated code did not finish within {timeout} seconds")
+        status, value = receiver.recv()
+    except EOFError:
+        raise RuntimeError("generated code exited without a result") from None
+    finally:
+        receiver.close()
+        if process.is_alive():
+            process.kill()
+        process.join()
+
+    if status == 'error':
+        raise value
+    return value
@@ -0,0 +1,68 @@
+import threading
+
+import numpy as np
+
+
+EMBEDDING_MODEL = "text-embedding-3-small"
+
+
+def embed_text(openai_client, text):
+    """Embed text with OpenAI and return a unit-normalized float32 vector"""
+    response = openai_client.embeddings.create(model=EMBEDDING_MODEL, input=text)
+    vector = np.asarray(response.data[0].embedding, dtype=np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+def embed_texts(openai_client, texts):
+    """Embed several texts in one request; rows are unit-normalized float32 vectors"""
+    response = openai_client.embeddings.create(model=EMBEDDING_MODEL, input=list(texts))
+    matrix = np.asarray([item.embedding for item in response.data], dtype=np.float32)
+    return matrix / np.linalg.norm(matrix, axis=1, keepdims=True)
+
+
+class SemanticCache:
+    """Cache that returns the stored value of the most similar earlier question.
+    
+    Values can be stored with slots (e.g. the numbers and months of the
+    question); a lookup with slots only considers entries with equal slots.
+    """
+
+    def __init__(self, threshold, max_entries=256):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.embeddings = None  # (n, dim) float32 matrix of unit vectors
+        self.values = []
+        self.slots = []
+        self._lock = threading.Lock()  # shared between Streamlit sessions
+
+    def lookup(self, embedding, slots=None):
+        """Return the value whose embedding is closest to `embedding`, if similar enough"""
+        with self._lock:
+            if not self.values:
+                return None
+
+            # One matrix-vector product scores every cached question; on ties
+            # the newest entry wins so re-added answers replace stale ones
+            scores = self.embeddings @ embedding
+            if slots is not None:
+                scores = np.where([entry == slots for entry in self.slots], scores, -np.inf)
+            best = len(scores) - 1 - int(np.argmax(scores[::-1]))
+            if scores[best] >= self.threshold:
+                return self.values[best]
+            return None
+
+    def add(self, embedding, value, slots=None):
+        """Store a value under an embedding, evicting the oldest entry when full"""
+        row = embedding.astype(np.float32)[np.newaxis, :]
+        with self._lock:
+            if self.embeddings is None:
+                self.embeddings = row
+            else:
+                self.embeddings = np.vstack([self.embeddings, row])
+            self.values.append(value)
+            self.slots.append(slots)
+
+            if len(self.values) > self.max_entries:
+                self.embeddings = self.embeddings[1:]
+                self.values.pop(0)
+                self.slots.pop(0)
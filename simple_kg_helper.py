@@ -1,192 +1,355 @@
-from neo4j import GraphDatabase
+from neo4j import GraphDatabase, READ_ACCESS, RoutingControl
+from neo4j.exceptions import ClientError
 from openai import OpenAI
-import json
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import atexit
+import functools
+import hashlib
+import itertools
+import logging
+import orjson
+import re
+import threading
+import time
 import streamlit as st
 
+from semantic_cache import SemanticCache, embed_text, embed_texts
 
-class SimpleKGHelper:
-    
-    def __init__(self, uri, user, password, openai_client):
-        self.driver = GraphDatabase.driver(uri, auth=(user, password))
-        self.openai = openai_client
-    
-    def close(self):
-        self.driver.close()
-    
-    def should_use_kg(self, question):
-        """Ask GPT if this query needs Knowledge Graph"""
-        
-        decision_prompt = f"""Decide if this question needs a graph database or simple processing.
 
-Question: "{question}"
+logger = logging.getLogger(__name__)
+
+
+# Log level for each kind of status message
+NOTIFY_LOG_LEVELS = {
+    'info': logging.INFO,
+    'success': logging.INFO,
+    'warning': logging.WARNING,
+    'error': logging.ERROR
+}
+
+# Indexes behind the lookups every generated query starts with. Date ranges
+# and transaction types get separate indexes so each serves filters on its own
+# (this replaces an earlier composite index on both)
+SCHEMA_INDEXES = [
+    "CREATE INDEX category_name IF NOT EXISTS FOR (c:Category) ON (c.name)",
+    "CREATE INDEX merchant_name IF NOT EXISTS FOR (m:Merchant) ON (m.name)",
+    "DROP INDEX transaction_date_type IF EXISTS",
+    "CREATE RANGE INDEX transaction_date IF NOT EXISTS FOR (t:Transaction) ON (t.date)",
+    "CREATE INDEX transaction_type IF NOT EXISTS FOR (t:Transaction) ON (t.transaction_type)"
+]
+# User.id gets a uniqueness constraint, whose own index replaces the plain
+# user_id index (both can't exist together). The plain index is only dropped
+# once the constraint can be created, and comes back if creating it fails
+USER_ID_CONSTRAINT = "CREATE CONSTRAINT user_id_unique IF NOT EXISTS FOR (u:User) REQUIRE u.id IS UNIQUE"
+USER_ID_INDEX = "CREATE INDEX user_id IF NOT EXISTS FOR (u:User) ON (u.id)"
+_indexed_databases = set()  # (uri, database) pairs already checked in this process
+_indexes_lock = threading.Lock()
+
+# Map app UUIDs to Neo4j user IDs
+UUID_TO_USER_ID = {
+    '34894ece-9ae4-4522-a5e0-21d3b8f6232c': 'user1',
+    '7487ccf8-c480-4c49-b20c-ba3c8d21a4bb': 'user2',
+    '96485aa1-ccef-4423-a709-8ba56f3ae844': 'user3',
+    'd3f6dc6d-badb-4b8f-ae52-db4185c622f7': 'user4'
+}
+
+# Strict structured output for the Cypher generator. Strict mode has no
+# free-form objects, so parameters come back as name/value pairs
+CYPHER_RESPONSE_SCHEMA = {
+    "name": "cypher_query",
+    "strict": True,
+    "schema": {
+        "type": "object",
+        "properties": {
+            "cypher": {"type": "string"},
+            "parameters": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "name": {"type": "string"},
+                        "value": {
+                            "anyOf": [
+                                {"type": "string"},
+                                {"type": "number"},
+                                {"type": "array", "items": {"type": "string"}}
+                            ]
+                        }
+                    },
+                    "required": ["name", "value"],
+                    "additionalProperties": False
+                }
+            }
+        },
+        "required": ["cypher", "parameters"],
+        "additionalProperties": False
+    }
+}
 
+# Cypher string literals, single- or double-quoted
+CYPHER_STRING_RE = re.compile(r"'(?:[^'\\]|\\.)*'" r'|"(?:[^"\\]|\\.)*"')
+# `IN [...]` lists made only of string literals
+CYPHER_IN_LIST_RE = re.compile(
+    r"\bIN\s*\[\s*((?:%(s)s)(?:\s*,\s*(?:%(s)s))*)\s*\]" % {'s': CYPHER_STRING_RE.pattern},
+    re.IGNORECASE
+)
+
+# Common question shapes answered with hand-written Cypher instead of an LLM
+# call. Each entry maps a pattern, matched against the whole question, to its
+# query and a function turning the match into parameters ($user_id is added
+# by query_kg)
+_TEMPLATES = [
+    (
+        re.compile(r"(?:мои\s+|my\s+)?(?:топ|top)[\s-]*(\d+)\s+(?:магазин\w*|merchants?|shops?|stores?)(?:\s+по\s+расходам|\s+by\s+spending)?", re.IGNORECASE),
+        "MATCH (u:User {id: $user_id})-[:MADE_TRANSACTION]->(t:Transaction)-[:AT_MERCHANT]->(m:Merchant) "
+        "WHERE t.transaction_type = 'outcome' "
+        "RETURN m.name AS merchant, sum(toFloat(t.amount_uc)) AS total_spent, count(t) AS visits "
+        "ORDER BY total_spent DESC LIMIT $n",
+        lambda match: {'n': int(match.group(1))}
+    ),
+    (
+        re.compile(r"(?:мои\s+|my\s+)?(?:топ|top)[\s-]*(\d+)\s+(?:категори\w*|categories)(?:\s+по\s+расходам|\s+by\s+spending)?", re.IGNORECASE),
+        "MATCH (u:User {id: $user_id})-[:MADE_TRANSACTION]->(t:Transaction)-[:IN_CATEGORY]->(c:Category) "
+        "WHERE t.transaction_type = 'outcome' "
+        "RETURN c.name AS category, sum(toFloat(t.amount_uc)) AS total_spent, count(t) AS transaction_count "
+        "ORDER BY total_spent DESC LIMIT $n",
+        lambda match: {'n': int(match.group(1))}
+    ),
+    (
+        re.compile(r"(?:мои\s+)?(?:расходы|траты)\s+по\s+категориям|(?:my\s+)?spending\s+by\s+category", re.IGNORECASE),
+        "MATCH (u:User {id: $user_id})-[:MADE_TRANSACTION]->(t:Transaction)-[:IN_CATEGORY]->(c:Category) "
+        "WHERE t.transaction_type = 'outcome' "
+        "RETURN c.name AS category, sum(toFloat(t.amount_uc)) AS total_spent, count(t) AS transaction_count "
+        "ORDER BY total_spent DESC",
+        lambda match: {}
+    )
+]
+
+# Paraphrases of an already routed question take the same route
+ROUTE_SEMANTIC_THRESHOLD = 0.85
+# Canonical questions seeding the routing cache: True routes to the Knowledge Graph
+ROUTING_EXAMPLES = [
+    ("Топ 5 магазинов по расходам", True),
+    ("Покажи мои топ магазины", True),
+    ("Top 5 merchants by spending", True),
+    ("Where do I spend the most money?", True),
+    ("Сравни мои затраты на кафе и продукты", True),
+    ("Compare my spending on restaurants and groceries", True),
+    ("В каких категориях я трачу больше всего?", True),
+    ("Which categories do I spend the most on?", True),
+    ("Где я обычно покупаю продукты?", True),
+    ("Where do I usually buy groceries?", True),
+    ("Как часто я езжу на такси?", True),
+    ("How often do I take a taxi?", True),
+    ("Какие магазины относятся к категории Продукты?", True),
+    ("Which merchants belong to the food category?", True),
+    ("Расходы по подкатегориям еды", True),
+    ("Сколько я потратил в прошлом месяце?", False),
+    ("How much did I spend last month?", False),
+    ("Сколько я потратил на такси?", False),
+    ("How much did I spend on groceries?", False),
+    ("Какой мой общий доход?", False),
+    ("What is my total income?", False),
+    ("Когда была моя последняя покупка?", False),
+    ("When was my last purchase?", False),
+    ("Покажи мои траты за январь", False),
+    ("Show my transactions from January", False),
+    ("Какая была самая большая покупка?", False),
+    ("What was my biggest purchase?", False),
+    ("Средний чек в кафе", False),
+    ("What is my average transaction amount?", False),
+    ("Сколько транзакций у меня было в декабре?", False)
+]
+
+# Row cap for KG queries: enforced while reading the cursor, with one extra
+# row (LIMIT KG_MAX_ROWS + 1 when a query has no LIMIT) to detect truncation
+KG_MAX_ROWS = 50
+LIMIT_RE = re.compile(r"\bLIMIT\b", re.IGNORECASE)
+
+# Generated Cypher reused across questions that differ only in numbers and
+# category names (the slots)
+TEMPLATE_CACHE_SIZE = 256
+CYPHER_CACHE_SIZE = 256  # generated Cypher by exact question
+EXPLAINED_CACHE_SIZE = 1024  # Cypher texts known to plan; reset when full
+NUMBER_SLOT_RE = re.compile(r"\d+")
+# Month names, English (full or abbreviated) and Russian in any case, by month number
+MONTH_SLOT_PATTERNS = [
+    r"jan(?:uary)?|январ[ьяею]",
+    r"feb(?:ruary)?|феврал[ьяею]",
+    r"mar(?:ch)?|март[аеу]?",
+    r"apr(?:il)?|апрел[ьяею]",
+    r"may|ма[йяею]",
+    r"june?|июн[ьяею]",
+    r"july?|июл[ьяею]",
+    r"aug(?:ust)?|август[аеу]?",
+    r"sep(?:t(?:ember)?)?|сентябр[ьяею]",
+    r"oct(?:ober)?|октябр[ьяею]",
+    r"nov(?:ember)?|ноябр[ьяею]",
+    r"dec(?:ember)?|декабр[ьяею]"
+]
+MONTH_SLOT_RE = re.compile(
+    r"(?<!\w)(?:" + "|".join(f"(?P<m{number}>{pattern})" for number, pattern in enumerate(MONTH_SLOT_PATTERNS, 1)) + r")(?!\w)",
+    re.IGNORECASE
+)
+
+LLM_CACHE_SIZE = 512  # identical requests answered without an API call
+
+# Answers to paraphrased questions are reused for a while per user
+KG_SEMANTIC_THRESHOLD = 0.93
+KG_RESULT_TTL = 600  # seconds
+
+# Output token bounds; the router answers with a single YES/NO token
+ROUTER_MODEL = "gpt-4o-mini"
+ROUTER_MAX_TOKENS = 1
+FORMAT_MAX_TOKENS = 300
+FORMAT_MAX_ROWS = 10  # result rows shown to the formatter
+# Columns whose values can be added up across rows (sums and counts), unless
+# the alias says it is an average, extreme, date part or rank
+ADDITIVE_COLUMN_HINTS = ('total', 'sum', 'spent', 'count', 'visits', 'transactions')
+NON_ADDITIVE_COLUMN_HINTS = ('avg', 'average', 'mean', 'median', 'max', 'min', 'year', 'month', 'day', 'rank', 'percent', 'share')
+
+# Result shapes simple enough to phrase without the formatter LLM call
+TEMPLATE_MAX_ROWS = 10
+TEMPLATE_MAX_TEXT = 60  # longer strings are treated as free text
+COUNT_COLUMN_HINTS = ('count', 'visits', 'number', 'transactions')
+AMOUNT_COLUMN_HINTS = ('total', 'sum', 'spent', 'amount', 'avg', 'average', 'income', 'expense', 'cost')
+# Languages the template formatter can answer in; others go to the LLM
+TEMPLATE_HEADERS = {
+    'RUS': "Вот что я нашёл:",
+    'ENG': "Here is what I found:"
+}
+# Column labels per language for the aliases the prompt and templates use.
+# English falls back to the alias itself; other languages go to the LLM
+TEMPLATE_COLUMN_LABELS = {
+    'RUS': {
+        'merchant': "магазин",
+        'category': "категория",
+        'group': "группа",
+        'total_spent': "потрачено",
+        'total_amount': "сумма",
+        'total': "итого",
+        'visits': "посещений",
+        'transaction_count': "транзакций",
+        'count': "количество"
+    },
+    'ENG': {}
+}
+
+# Wording that the router sends to the Knowledge Graph (comparisons, rankings,
+# habits) or to in-memory processing (totals, single lookups). When exactly one
+# of them matches, the route is decided locally without the routing LLM call
+KG_KEYWORDS_RE = re.compile(
+    r"\b(?:compare|vs|versus|top|most|often|usually|frequently|pattern\w*"
+    r"|сравн\w*|топ|больше всего|часто|чаще\w*|обычно|предпочита\w*)\b",
+    re.IGNORECASE
+)
+SIMPLE_KEYWORDS_RE = re.compile(
+    r"\b(?:how much|total|when|where|сколько|когда|где)\b",
+    re.IGNORECASE
+)
+
+
+# Static system prompts; the per-question parts go in a short user message so
+# the long shared prefix is eligible for OpenAI prompt caching. Blank lines are
+# left out on purpose, each one costs a token on every call
+ROUTER_SYSTEM_PROMPT = """You are a query router.
+Decide if the user's question needs a graph database or simple processing.
 Use Graph Database if:
 - Comparing multiple things (compare, vs, сравни)
 - Finding top/best (top 5, most, больше всего, топ)
 - Patterns (usually, often, frequently, часто, обычно)
 - Complex multi-dimensional analysis
 - Category hierarchy questions
-
 Use Simple Processing if:
 - Basic totals (how much, total, сколько)
 - Single lookups (when, where, когда)
 - Simple filtering
-
-Return JSON: {{"use_kg": true, "reasoning": "..."}} or {{"use_kg": false, "reasoning": "..."}}
+Answer with exactly one token: YES for Graph Database or NO for Simple Processing.
 """
-        
-        try:
-            st.info(f"🤖 Analyzing query complexity...")
-            
-            response = self.openai.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[
-                    {"role": "system", "content": "You are a query router. Return only valid JSON."},
-                    {"role": "user", "content": decision_prompt}
-                ],
-                temperature=0,
-                response_format={"type": "json_object"}
-            )
-            
-            result = json.loads(response.choices[0].message.content)
-            use_kg = result.get('use_kg', False)
-            reasoning = result.get('reasoning', 'Unknown')
-            
-            if use_kg:
-                st.success(f"✅ Using Knowledge Graph: {reasoning}")
-            else:
-                st.info(f"⚡ Using In-Memory: {reasoning}")
-            
-            return use_kg
-            
-        except Exception as e:
-            st.error(f"❌ Routing failed: {str(e)}")
-            st.warning("Defaulting to in-memory processing")
-            return False
-    
-    def query_kg(self, question, user_id, currency):
-        """Generate Cypher and query Neo4j with NEW SCHEMA"""
-        
-        # Map UUID to Neo4j user ID
-        uuid_to_user_id = {
-            '34894ece-9ae4-4522-a5e0-21d3b8f6232c': 'user1',
-            '7487ccf8-c480-4c49-b20c-ba3c8d21a4bb': 'user2',
-            '96485aa1-ccef-4423-a709-8ba56f3ae844': 'user3',
-            'd3f6dc6d-badb-4b8f-ae52-db4185c622f7': 'user4'
-        }
-        
-        # Convert UUID to user_id if needed
-        neo4j_user_id = uuid_to_user_id.get(user_id, user_id)
-        
-        cypher_prompt = f"""
-⚠️⚠️⚠️ CRITICAL SCHEMA WARNING ⚠️⚠️⚠️
-THIS SCHEMA HAS CHANGED! DO NOT USE OLD PATTERNS!
-- NO Account nodes exist
-- NO from_account properties exist  
-- NO [:FROM_ACCOUNT] relationships exist
-- NO [:MADE_AT] relationships exist
-ONLY use the exact relationships listed below!
 
+CYPHER_SYSTEM_PROMPT = """You are a Cypher expert for Neo4j. CRITICAL: This graph has User nodes (NOT Account nodes). Relationships are [:MADE_TRANSACTION], [:AT_MERCHANT], [:IN_CATEGORY]. NO [:FROM_ACCOUNT] or [:MADE_AT] relationships exist. Always start queries with (u:User {id: $user_id})-[:MADE_TRANSACTION]->(t:Transaction). Return only valid JSON.
 **Introduction**
 You are an expert Cypher query generator for Neo4j graph database. Your task is to convert natural language questions about financial transactions into accurate, efficient Cypher queries.
-
 **Graph Schema (EXACT structure - NEW SCHEMA)**
-
 Nodes:
 1. User
    - Properties: id (string), name (string - UUID)
    - Represents user accounts
-
 2. Transaction
    - Properties: id (string), name (string - transaction ID like 'T1'), date (string), transaction_type (string: 'income' or 'outcome'), currency (string), amount (string), amount_uc (string - unified currency amount)
    - This is the CENTRAL node connecting all entities
-
 3. Merchant
    - Properties: id (string), name (string)
    - Represents vendors/payees
-
 4. Category
    - Properties: id (string), name (string)
    - User-defined spending categories (e.g., 'Продукты', 'Кафе и рестораны', 'Такси')
    - Has parent-child hierarchy for grouping
-
 Relationships (use EXACT names - DO NOT USE ANY OTHER NAMES):
 - (User)-[:MADE_TRANSACTION]->(Transaction)  ⚠️ NOT [:FROM_ACCOUNT], NOT [:MADE_BY]
 - (Transaction)-[:AT_MERCHANT]->(Merchant)  ⚠️ NOT [:MADE_AT], NOT [:TO_MERCHANT]
 - (Transaction)-[:IN_CATEGORY]->(Category)  ⚠️ NOT [:BELONGS_TO] for transactions
 - (Merchant)-[:BELONGS_TO]->(Category)
 - (Category)-[:BELONGS_TO]->(Category) [for hierarchy - child to parent]
-
-⚠️ CRITICAL: There is NO Account node. There is NO from_account property. ONLY use User node!
-
 **CRITICAL RULES - READ CAREFULLY**
-
 1. USER FILTERING (MANDATORY):
-   - ⚠️ THERE IS NO ACCOUNT NODE IN THIS SCHEMA
-   - ⚠️ THERE IS NO from_account OR account_id PROPERTY
-   - ⚠️ DO NOT USE [:FROM_ACCOUNT] - IT DOES NOT EXIST
-   - CORRECT PATTERN: MATCH (u:User {{id: $user_id}})-[:MADE_TRANSACTION]->(t:Transaction)
+   - CORRECT PATTERN: MATCH (u:User {id: $user_id})-[:MADE_TRANSACTION]->(t:Transaction)
    - WRONG: (t:Transaction)-[:FROM_ACCOUNT]->(a:Account)
    - WRONG: WHERE t.account_id = $user_id
    - WRONG: WHERE t.from_account = $user_id
    - Every query MUST start with User node and traverse via MADE_TRANSACTION
-
 2. PROPERTY NAMES:
    - Use toFloat(t.amount_uc) for monetary totals (user's default currency)
    - Use toFloat(t.amount) for original transaction amounts
    - Use t.transaction_type for transaction type ('income' or 'outcome')
    - Use t.date for dates (stored as string 'YYYY-MM-DD')
-   - IMPORTANT: amount and amount_uc are stored as STRINGS, use toFloat() to convert
-
+   - IMPORTANT: amount and amount_uc may be stored as STRINGS, always use toFloat() (it also accepts floats)
 3. AGGREGATIONS:
    - For totals: sum(toFloat(t.amount_uc))
    - For counts: count(t)
    - For averages: avg(toFloat(t.amount_uc))
    - Always convert strings to float for calculations
-
 4. FILTERING:
-   - For expenses only: WHERE t.transaction_type = 'outcome'
-   - For income only: WHERE t.transaction_type = 'income'
-   - For date ranges: WHERE t.date >= '2022-09-01' AND t.date <= '2023-02-28'
-
+   - For expenses only: WHERE t.transaction_type = $tx_type with tx_type = 'outcome'
+   - For income only: WHERE t.transaction_type = $tx_type with tx_type = 'income'
+   - For date ranges: WHERE t.date >= $start_date AND t.date <= $end_date (values like '2022-09-01')
 5. SORTING AND LIMITS:
    - Use ORDER BY for rankings (DESC for highest first)
-   - Include LIMIT when asked for "top N" or "best"
+   - Include LIMIT only when asked for "top N" or "best"; otherwise leave it out, the application caps the rows
    - Default to DESC for monetary amounts
-
 6. CATEGORY NAMES:
    - Russian categories must match EXACTLY as stored
    - Common categories: 'Продукты', 'Кафе и рестораны', 'Такси', 'Лекарства', 'Овощи и фрукты'
-   - Use c.name IN ['Cat1', 'Cat2'] for multiple categories
+   - Use c.name IN $categories for multiple categories, c.name = $category for one
    - Case-sensitive matching
-
+   - If the user message lists Categories, they are the exact stored names found in the question; filter with c.name IN $categories and pass that list
 7. MERCHANT RELATIONSHIPS:
    - Merchants are linked to categories: (m:Merchant)-[:BELONGS_TO]->(c:Category)
    - You can navigate from Transaction to Merchant to Category
    - IMPORTANT: To filter by transaction category, use (t)-[:IN_CATEGORY]->(c:Category)
    - To filter by merchant's typical category, use (m)-[:BELONGS_TO]->(c:Category)
    - Most queries about "spending in category X" should filter transactions, not merchants!
-
 8. CATEGORY HIERARCHY:
    - Parent categories exist (e.g., 'Еда и напитки' contains 'Продукты', 'Кафе и рестораны')
    - To get all transactions in a parent category:
-     MATCH (child:Category)-[:BELONGS_TO]->(parent:Category {{name: 'Еда и напитки'}})
+     MATCH (child:Category)-[:BELONGS_TO]->(parent:Category {name: $parent_category})
      MATCH (t:Transaction)-[:IN_CATEGORY]->(child)
-
 9. RETURN CLAUSE:
    - Use descriptive aliases: AS total, AS merchant, AS category, AS count
    - Format for readability
    - Return only necessary columns
-
+10. PARAMETERS (MANDATORY):
+   - Never write string, number or date literals into the query; use $name placeholders
+   - Put every value in "parameters": category names, transaction types, dates, LIMIT counts
+   - The query text must be the same for questions that differ only in these values
 **Input Context**
-- Current User ID: {neo4j_user_id}
-- User's Default Currency: {currency}
-- Question: "{question}"
-
+The user message gives the user's default currency, the question and, when the
+question names known categories, their stored names. The current
+user ID is passed at runtime as $user_id (never write it into the query).
 ⚠️ SCHEMA REMINDER: Start EVERY query with:
-MATCH (u:User {{id: $user_id}})-[:MADE_TRANSACTION]->(t:Transaction)
+MATCH (u:User {id: $user_id})-[:MADE_TRANSACTION]->(t:Transaction)
 Then continue with -[:AT_MERCHANT]->(m:Merchant) or -[:IN_CATEGORY]->(c:Category) as needed.
-
 **Task**
 Generate a Cypher query that:
 1. Answers the user's question accurately
@@ -195,143 +358,959 @@ Generate a Cypher query that:
 4. Converts string amounts to float using toFloat()
 5. Returns results with clear column names
 6. Handles Russian text correctly
-
 **Output Format**
-Return ONLY valid JSON (no markdown, no explanations):
-{{
-  "cypher": "MATCH (u:User {{id: $user_id}})-[:MADE_TRANSACTION]->(t:Transaction) ...",
-  "parameters": {{
-    "user_id": "{neo4j_user_id}"
-  }}
-}}
-
+Return ONLY valid JSON (no markdown, no explanations). "parameters" lists any extra
+query parameters as {"name": ..., "value": ...} objects; $user_id is always supplied
+by the application:
+{
+  "cypher": "MATCH (u:User {id: $user_id})-[:MADE_TRANSACTION]->(t:Transaction) ...",
+  "parameters": []
+}
 **Examples**
-
 Example 1: "Топ 5 магазинов по расходам"
-{{
-  "cypher": "MATCH (u:User {{id: $user_id}})-[:MADE_TRANSACTION]->(t:Transaction)-[:AT_MERCHANT]->(m:Merchant) WHERE t.transaction_type = 'outcome' RETURN m.name AS merchant, sum(toFloat(t.amount_uc)) AS total_spent, count(t) AS visits ORDER BY total_spent DESC LIMIT 5",
-  "parameters": {{
-    "user_id": "{user_id}"
-  }}
-}}
-
+{
+  "cypher": "MATCH (u:User {id: $user_id})-[:MADE_TRANSACTION]->(t:Transaction)-[:AT_MERCHANT]->(m:Merchant) WHERE t.transaction_type = $tx_type RETURN m.name AS merchant, sum(toFloat(t.amount_uc)) AS total_spent, count(t) AS visits ORDER BY total_spent DESC LIMIT $limit",
+  "parameters": [{"name": "tx_type", "value": "outcome"}, {"name": "limit", "value": 5}]
+}
 Example 2: "Сравни мои затраты на 'Кафе и рестораны' и 'Продукты'"
-{{
-  "cypher": "MATCH (u:User {{id: $user_id}})-[:MADE_TRANSACTION]->(t:Transaction)-[:IN_CATEGORY]->(c:Category) WHERE c.name IN ['Кафе и рестораны', 'Продукты'] AND t.transaction_type = 'outcome' RETURN c.name AS category, sum(toFloat(t.amount_uc)) AS total_spent, count(t) AS transaction_count ORDER BY total_spent DESC",
-  "parameters": {{
-    "user_id": "{user_id}"
-  }}
-}}
-
+{
+  "cypher": "MATCH (u:User {id: $user_id})-[:MADE_TRANSACTION]->(t:Transaction)-[:IN_CATEGORY]->(c:Category) WHERE c.name IN $categories AND t.transaction_type = $tx_type RETURN c.name AS category, sum(toFloat(t.amount_uc)) AS total_spent, count(t) AS transaction_count ORDER BY total_spent DESC",
+  "parameters": [{"name": "categories", "value": ["Кафе и рестораны", "Продукты"]}, {"name": "tx_type", "value": "outcome"}]
+}
 Example 3: "Сколько транзакций у категории Такси?"
-{{
-  "cypher": "MATCH (u:User {{id: $user_id}})-[:MADE_TRANSACTION]->(t:Transaction)-[:IN_CATEGORY]->(c:Category {{name: 'Такси'}}) RETURN count(t) AS transaction_count, sum(toFloat(t.amount_uc)) AS total_amount",
-  "parameters": {{
-    "user_id": "{user_id}"
-  }}
-}}
-
+{
+  "cypher": "MATCH (u:User {id: $user_id})-[:MADE_TRANSACTION]->(t:Transaction)-[:IN_CATEGORY]->(c:Category {name: $category}) RETURN count(t) AS transaction_count, sum(toFloat(t.amount_uc)) AS total_amount",
+  "parameters": [{"name": "category", "value": "Такси"}]
+}
 Example 4: "Все мои расходы на еду" (using parent category)
-{{
-  "cypher": "MATCH (u:User {{id: $user_id}})-[:MADE_TRANSACTION]->(t:Transaction)-[:IN_CATEGORY]->(child:Category)-[:BELONGS_TO]->(parent:Category {{name: 'Еда и напитки'}}) WHERE t.transaction_type = 'outcome' RETURN child.name AS category, sum(toFloat(t.amount_uc)) AS total_spent ORDER BY total_spent DESC",
-  "parameters": {{
-    "user_id": "{user_id}"
-  }}
-}}
-
+{
+  "cypher": "MATCH (u:User {id: $user_id})-[:MADE_TRANSACTION]->(t:Transaction)-[:IN_CATEGORY]->(child:Category)-[:BELONGS_TO]->(parent:Category {name: $parent_category}) WHERE t.transaction_type = $tx_type RETURN child.name AS category, sum(toFloat(t.amount_uc)) AS total_spent ORDER BY total_spent DESC",
+  "parameters": [{"name": "parent_category", "value": "Еда и напитки"}, {"name": "tx_type", "value": "outcome"}]
+}
 Example 5: "Топ 5 магазинов в категории Продукты" (merchants for specific transaction category)
-{{
-  "cypher": "MATCH (u:User {{id: $user_id}})-[:MADE_TRANSACTION]->(t:Transaction)-[:AT_MERCHANT]->(m:Merchant) MATCH (t)-[:IN_CATEGORY]->(c:Category {{name: 'Продукты'}}) WHERE t.transaction_type = 'outcome' RETURN m.name AS merchant, sum(toFloat(t.amount_uc)) AS total_spent, count(t) AS visits ORDER BY total_spent DESC LIMIT 5",
-  "parameters": {{
-    "user_id": "{user_id}"
-  }}
-}}
-
+{
+  "cypher": "MATCH (u:User {id: $user_id})-[:MADE_TRANSACTION]->(t:Transaction)-[:AT_MERCHANT]->(m:Merchant) MATCH (t)-[:IN_CATEGORY]->(c:Category {name: $category}) WHERE t.transaction_type = $tx_type RETURN m.name AS merchant, sum(toFloat(t.amount_uc)) AS total_spent, count(t) AS visits ORDER BY total_spent DESC LIMIT $limit",
+  "parameters": [{"name": "category", "value": "Продукты"}, {"name": "tx_type", "value": "outcome"}, {"name": "limit", "value": 5}]
+}
 **Important Reminders**
 - ALWAYS start with User node and filter by user_id
 - Use toFloat() for amount and amount_uc in calculations
 - Match category names EXACTLY (case-sensitive, with Russian characters)
+- Pass every literal value as a parameter
 - Always return meaningful column aliases
 - Test logic: does this query actually answer the question?
+Generate the Cypher query for the question in the user message.
+"""
 
-Now generate the Cypher query for the question above.
+FORMAT_SYSTEM_PROMPT = """You are a helpful financial assistant. Convert the query results in the user message to a natural answer to the question.
+Results hold the first rows of the query output, rows_returned (how many rows the query returned) and truncated (true when the query had even more rows that were not read); mention when only part of the rows are shown.
+When rows are cut, column_totals adds up the sum and count columns over the returned rows; use it for overall figures, and say they are partial when truncated is true.
+Instructions:
+- Be conversational and clear
+- Format numbers with proper currency symbols
+- Use the user's language
+- Keep it concise but informative
+Provide ONLY the answer, no additional commentary.
 """
+
+
+# toFloat() around amounts is only needed while they are stored as strings.
+# After migrate_amounts.py (and numeric_amounts = true in the [neo4j] secrets)
+# queries aggregate the float properties directly, and the prompt says so
+TO_FLOAT_AMOUNT_RE = re.compile(r"toFloat\((t\.amount(?:_uc)?)\)")
+NUMERIC_AMOUNT_PROMPT_LINES = {
+    "amount (string), amount_uc (string - unified currency amount)":
+        "amount (float), amount_uc (float - unified currency amount)",
+    "IMPORTANT: amount and amount_uc may be stored as STRINGS, always use toFloat() (it also accepts floats)":
+        "IMPORTANT: amount and amount_uc are stored as floats; never wrap them in toFloat()",
+    "Always convert strings to float for calculations":
+        "Aggregate amounts directly, they are already floats",
+    "Converts string amounts to float using toFloat()":
+        "Aggregates the float amounts directly",
+    "Use toFloat() for amount and amount_uc in calculations":
+        "Use amount and amount_uc directly in calculations (they are floats)"
+}
+
+
+def numeric_amount_cypher(text):
+    """Cypher or prompt text without toFloat() around amounts, for migrated graphs"""
+    text = TO_FLOAT_AMOUNT_RE.sub(r"\1", text)
+    for line, numeric_line in NUMERIC_AMOUNT_PROMPT_LINES.items():
+        text = text.replace(line, numeric_line)
+    return text
+
+
+NUMERIC_CYPHER_SYSTEM_PROMPT = numeric_amount_cypher(CYPHER_SYSTEM_PROMPT)
+
+
+def canonicalize_cypher(cypher, parameters):
+    """Move literal IN-lists into parameters and normalize whitespace.
+    
+    Neo4j caches plans by query text, so `c.name IN ['Такси']` and
+    `c.name IN ['Продукты']` would each be planned separately; as
+    `c.name IN $in_list_0` they share one plan.
+    """
+    parameters = dict(parameters)
+    lists = []
+    
+    def to_parameter(match):
+        name = f"in_list_{len(lists)}"
+        lists.append(name)
+        parameters[name] = [
+            literal.group()[1:-1].replace("\\'", "'").replace('\\"', '"')
+            for literal in CYPHER_STRING_RE.finditer(match.group(1))
+        ]
+        return f"IN ${name}"
+    
+    cypher = CYPHER_IN_LIST_RE.sub(to_parameter, cypher)
+    
+    # Collapse whitespace outside string literals (category names may end in spaces)
+    pieces = []
+    position = 0
+    for literal in CYPHER_STRING_RE.finditer(cypher):
+        pieces.append(re.sub(r"\s+", " ", cypher[position:literal.start()]))
+        pieces.append(literal.group())
+        position = literal.end()
+    pieces.append(re.sub(r"\s+", " ", cypher[position:]))
+    return "".join(pieces).strip(), parameters
+
+
+@functools.cache
+def router_logit_bias():
+    """logit_bias limiting the router's answer to the YES and NO tokens, or None.
+    
+    The token ids come from tiktoken; without it (or if either word is not a
+    single token) the router runs unconstrained and unexpected answers are logged.
+    """
+    try:
+        import tiktoken
+        encoding = tiktoken.encoding_for_model(ROUTER_MODEL)
+        tokens = [encoding.encode(word) for word in ("YES", "NO")]
+    except Exception as e:
+        logger.warning("Router runs without logit_bias: %s", e)
+        return None
+    if any(len(ids) != 1 for ids in tokens):
+        logger.warning("Router runs without logit_bias: YES/NO are not single tokens")
+        return None
+    return {str(ids[0]): 100 for ids in tokens}
+
+
+def category_matcher(names):
+    """Regex finding any of the category names in a question, and the stored names by lowercase name.
+    
+    Returns (None, {}) without names.
+    """
+    # Some stored names end in a space; match without it but keep the stored value
+    category_names = {name.strip().lower(): name for name in names if name and name.strip()}
+    if not category_names:
+        return None, {}
+    # Longest names first so "Кафе и рестораны" wins over shorter overlaps
+    patterns = sorted(category_names, key=len, reverse=True)
+    category_re = re.compile(
+        r"(?<!\w)(?:" + "|".join(re.escape(name) for name in patterns) + r")(?!\w)",
+        re.IGNORECASE
+    )
+    return category_re, category_names
+
+
+def question_template(question, category_re=None, category_names=None):
+    """Split a question into a template and its slot values (categories, months, numbers).
+    
+    Questions with the same template differ only in their slots. Cached
+    answers are only reused for equal slots: "топ 5" and "топ 10", or March
+    and April, embed almost identically but need different results.
+    """
+    slots = []
+    
+    def category_slot(match):
+        slots.append(category_names[match.group().lower()])
+        return "{category}"
+    
+    def month_slot(match):
+        slots.append(('month', int(match.lastgroup[1:])))
+        return "{month}"
+    
+    def number_slot(match):
+        slots.append(int(match.group()))
+        return "{number}"
+    
+    text = " ".join(question.lower().split()).rstrip("?!. ")
+    if category_re is not None:
+        text = category_re.sub(category_slot, text)
+    text = MONTH_SLOT_RE.sub(month_slot, text)
+    text = NUMBER_SLOT_RE.sub(number_slot, text)
+    # Category slots come first, then months and numbers, each in question order
+    return text, slots
+
+
+def with_row_limit(cypher):
+    """Append the row cap (plus one row to detect truncation) to queries without a LIMIT"""
+    if LIMIT_RE.search(cypher):
+        return cypher
+    return f"{cypher} LIMIT {KG_MAX_ROWS + 1}"
+
+
+# The hand-written queries (with or without toFloat) are known to plan, so they skip EXPLAIN
+_TEMPLATE_CYPHER = frozenset(
+    with_row_limit(variant)
+    for _, cypher, _ in _TEMPLATES
+    for variant in (cypher, numeric_amount_cypher(cypher))
+)
+
+
+class SimpleKGHelper:
+    
+    def __init__(self, uri, user, password, openai_client, database="neo4j",
+                 formatter_client=None, formatter_model=None, verbose=False, numeric_amounts=False):
+        # Status messages always go to the log; only shown in the UI when verbose
+        self.verbose = verbose
+        # Once migrate_amounts.py has stored amounts as floats, queries skip toFloat()
+        if numeric_amounts:
+            self._cypher_system_prompt = NUMERIC_CYPHER_SYSTEM_PROMPT
+            self._templates = [
+                (pattern, numeric_amount_cypher(cypher), to_parameters)
+                for pattern, cypher, to_parameters in _TEMPLATES
+            ]
+        else:
+            self._cypher_system_prompt = CYPHER_SYSTEM_PROMPT
+            self._templates = _TEMPLATES
+        self.driver = GraphDatabase.driver(
+            uri,
+            auth=(user, password),
+            max_connection_pool_size=50,
+            connection_acquisition_timeout=5  # fail fast to the in-memory fallback
+        )
+        # Naming the database up front saves the home-database lookup per session
+        self.database = database
+        self.ensure_indexes(uri)
+        self.openai = openai_client
+        # Optional cheaper (e.g. local OpenAI-compatible) model for phrasing
+        # plain tabular results; irregular results still go to gpt-4o-mini
+        self.formatter_client = formatter_client
+        self.formatter_model = formatter_model
+        # Generated Cypher only depends on the question and currency (the user is
+        # passed as $user_id), so repeated questions skip the LLM call. An
+        # OrderedDict rather than lru_cache so a repaired query can replace it
+        self._cypher_cache = OrderedDict()
+        self._cypher_cache_lock = threading.Lock()
+        # Generated Cypher texts that already passed EXPLAIN
+        self._explained_cypher = set()
+        self._explained_cypher_lock = threading.Lock()
+        # Routing decisions repeat just as often; keyed on the normalized question
+        self._route_cached = functools.lru_cache(maxsize=1024)(self._route_uncached)
+        # Routes of earlier questions by embedding, seeded with ROUTING_EXAMPLES
+        self._route_semantic = SemanticCache(threshold=ROUTE_SEMANTIC_THRESHOLD, max_entries=1024)
+        # Recent KG results per Neo4j user, looked up by question embedding
+        self._result_caches = {}
+        # Category names in the graph (loaded in the background) and Cypher by
+        # question template
+        self._category_re = None
+        self._category_names = {}
+        self._template_cache = OrderedDict()
+        self._template_cache_lock = threading.Lock()
+        # Completion texts by request hash, shared by every LLM call site
+        self._llm_cache = OrderedDict()
+        self._llm_cache_lock = threading.Lock()
+        # Background workers for the embedding and speculative Cypher generation
+        self._pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="kg-prefetch")
+        # Open the Neo4j and OpenAI connections before the first question needs them
+        threading.Thread(target=self._warm_up, name="kg-warm-up", daemon=True).start()
+    
+    def _notify(self, kind, message):
+        """Log a status message and, when verbose, show it with st.info/success/warning/error"""
+        logger.log(NOTIFY_LOG_LEVELS[kind], message)
+        if self.verbose:
+            getattr(st, kind)(message)
+    
+    def close(self):
+        self._pool.shutdown(wait=False)
+        self.driver.close()
+    
+    @staticmethod
+    def _llm_cache_key(request):
+        """SHA-256 of a chat request; whitespace in messages doesn't change the key"""
+        messages = [
+            {'role': message['role'], 'content': " ".join(message['content'].split())}
+            for message in request['messages']
+        ]
+        payload = orjson.dumps({**request, 'messages': messages}, option=orjson.OPT_SORT_KEYS)
+        return hashlib.sha256(payload).hexdigest()
+    
+    def _remember(self, key, content):
+        with self._llm_cache_lock:
+            self._llm_cache[key] = content
+            self._llm_cache.move_to_end(key)
+            if len(self._llm_cache) > LLM_CACHE_SIZE:
+                self._llm_cache.popitem(last=False)
+    
+    def _llm_cached(self, client=None, **request):
+        """Chat completion text for a request, answered from the exact-match cache when possible.
+        
+        With stream=True a miss returns a generator of text deltas, which caches
+        the full text once it has been consumed; a hit is always a string.
+        `client` overrides the default OpenAI client (the model is part of the key).
+        """
+        key = self._llm_cache_key(request)
+        with self._llm_cache_lock:
+            if key in self._llm_cache:
+                self._llm_cache.move_to_end(key)
+                return self._llm_cache[key]
+        
+        response = (client or self.openai).chat.completions.create(**request)
+        if not request.get('stream'):
+            content = response.choices[0].message.content or ""
+            self._remember(key, content)
+            return content
+        
+        def deltas():
+            chunks = []
+            for chunk in response:
+                if chunk.choices:
+                    text = chunk.choices[0].delta.content or ""
+                    chunks.append(text)
+                    yield text
+            self._remember(key, "".join(chunks))
+        
+        return deltas()
+    
+    def _load_categories(self):
+        """Compile a matcher for the category names stored in the graph"""
+        with self._read_session() as session:
+            names = session.execute_read(
+                lambda tx: [record['name'] for record in tx.run("MATCH (c:Category) RETURN DISTINCT c.name AS name")]
+            )
+        category_re, category_names = category_matcher(names)
+        if category_re is not None:
+            self._category_names = category_names
+            self._category_re = category_re
+    
+    def _question_template(self, question):
+        """Template and slot values of a question, with the categories stored in the graph"""
+        return question_template(question, self._category_re, self._category_names)
+    
+    @staticmethod
+    def _slot_mapping(parameters, slots):
+        """How each parameter is built from the slots, or None if that is ambiguous"""
+        if not slots or len(set(slots)) != len(slots):
+            return None
+        
+        mapping = {}
+        used = set()
+        for name, value in parameters.items():
+            if isinstance(value, list) and value and all(item in slots for item in value):
+                mapping[name] = ('list', [slots.index(item) for item in value])
+                used.update(mapping[name][1])
+            elif isinstance(value, (str, int)) and not isinstance(value, bool) and value in slots:
+                mapping[name] = ('slot', slots.index(value))
+                used.add(mapping[name][1])
+            else:
+                mapping[name] = ('fixed', value)
+        
+        # A slot missing from the parameters was written into the query itself
+        if used != set(range(len(slots))):
+            return None
+        return mapping
+    
+    def _cypher_for_question(self, question, currency):
+        """Cypher and parameters for a question, reusing queries of same-shaped questions"""
+        template, slots = self._question_template(question)
+        key = (template, currency, len(slots))
+        
+        with self._template_cache_lock:
+            entry = self._template_cache.get(key)
+            if entry is not None:
+                self._template_cache.move_to_end(key)
+        if entry is not None:
+            cypher, mapping = entry
+            parameters = {}
+            for name, (kind, value) in mapping.items():
+                if kind == 'slot':
+                    parameters[name] = slots[value]
+                elif kind == 'list':
+                    parameters[name] = [slots[index] for index in value]
+                else:
+                    parameters[name] = value
+            return cypher, parameters
         
+        question_key = (self._question_key(question), currency)
+        with self._cypher_cache_lock:
+            entry = self._cypher_cache.get(question_key)
+            if entry is not None:
+                self._cypher_cache.move_to_end(question_key)
+        if entry is not None:
+            return entry
+        
+        # Raises on a failed generation, so failures are not cached
+        cypher, parameters = self._generate_cypher_uncached(question_key[0], currency)
+        self._remember_cypher(question, currency, cypher, parameters)
+        return cypher, parameters
+    
+    def _remember_cypher(self, question, currency, cypher, parameters):
+        """Cache a question's Cypher, replacing earlier entries for it and its shape"""
+        question_key = (self._question_key(question), currency)
+        with self._cypher_cache_lock:
+            self._cypher_cache[question_key] = (cypher, parameters)
+            self._cypher_cache.move_to_end(question_key)
+            if len(self._cypher_cache) > CYPHER_CACHE_SIZE:
+                self._cypher_cache.popitem(last=False)
+        
+        template, slots = self._question_template(question)
+        key = (template, currency, len(slots))
+        mapping = self._slot_mapping(parameters, slots)
+        with self._template_cache_lock:
+            if mapping is None:
+                self._template_cache.pop(key, None)
+                return
+            self._template_cache[key] = (cypher, mapping)
+            self._template_cache.move_to_end(key)
+            if len(self._template_cache) > TEMPLATE_CACHE_SIZE:
+                self._template_cache.popitem(last=False)
+    
+    def _forget_cypher(self, question, currency):
+        """Drop a question's cached Cypher, for its shape and its generation call, so it is generated afresh"""
+        question_key = (self._question_key(question), currency)
+        with self._cypher_cache_lock:
+            self._cypher_cache.pop(question_key, None)
+        
+        template, slots = self._question_template(question)
+        with self._template_cache_lock:
+            self._template_cache.pop((template, currency, len(slots)), None)
+        
+        request_key = self._llm_cache_key(self._cypher_request(self._cypher_messages(*question_key)))
+        with self._llm_cache_lock:
+            self._llm_cache.pop(request_key, None)
+    
+    def _warm_up(self):
+        """Seed the routing cache and establish pooled connections in the background"""
+        router_logit_bias()  # tiktoken may download its encoding on first use
+        try:
+            # Doubles as the OpenAI connection warm-up
+            embeddings = embed_texts(self.openai, [question for question, _ in ROUTING_EXAMPLES])
+            for embedding, (_, use_kg) in zip(embeddings, ROUTING_EXAMPLES):
+                self._route_semantic.add(embedding, use_kg)
+        except Exception:
+            pass
         try:
-            st.info("🔧 Generating Cypher query...")
+            self.driver.verify_connectivity()
+            self._load_categories()
+        except Exception:
+            pass  # the first real query reports connection problems
+    
+    def _read_session(self):
+        """Read-only session for the category lookup"""
+        return self.driver.session(database=self.database, default_access_mode=READ_ACCESS)
+    
+    def ensure_indexes(self, uri):
+        """Create the schema indexes and constraints once per process and database (idempotent)"""
+        with _indexes_lock:
+            if (uri, self.database) in _indexed_databases:
+                return
+            try:
+                with self.driver.session(database=self.database) as session:
+                    self._ensure_user_id_constraint(session)
+                    for statement in SCHEMA_INDEXES:
+                        session.run(statement).consume()
+                _indexed_databases.add((uri, self.database))
+            except Exception as e:
+                # Read-only users can't create indexes; queries still work without them
+                self._notify('warning', f"⚠️ Could not ensure KG indexes: {e}")
+    
+    def _ensure_user_id_constraint(self, session):
+        """Make User.id unique, keeping the user lookup indexed if that isn't possible"""
+        exists = session.run(
+            "SHOW CONSTRAINTS YIELD name WHERE name = 'user_id_unique' RETURN count(*) AS n"
+        ).single()['n']
+        if exists:
+            return
+        
+        duplicate = session.run(
+            "MATCH (u:User) WITH u.id AS id, count(*) AS n WHERE n > 1 RETURN id LIMIT 1"
+        ).single()
+        if duplicate is not None:
+            self._notify('warning', f"⚠️ User.id is not unique (e.g. {duplicate['id']}); keeping the plain index")
+            session.run(USER_ID_INDEX).consume()
+            return
+        
+        session.run("DROP INDEX user_id IF EXISTS").consume()
+        try:
+            session.run(USER_ID_CONSTRAINT).consume()
+        except Exception as e:
+            session.run(USER_ID_INDEX).consume()
+            self._notify('warning', f"⚠️ Could not create the User.id constraint, kept the index: {e}")
+    
+    def _route_uncached(self, question):
+        """Ask GPT if this query needs Knowledge Graph"""
+        
+        decision_prompt = f'Question: "{question}"'
+        
+        self._notify('info', f"🤖 Analyzing query complexity...")
+        
+        request = {}
+        logit_bias = router_logit_bias()
+        if logit_bias:
+            request['logit_bias'] = logit_bias
+        answer = self._llm_cached(
+            model=ROUTER_MODEL,
+            messages=[
+                {"role": "system", "content": ROUTER_SYSTEM_PROMPT},
+                {"role": "user", "content": decision_prompt}
+            ],
+            temperature=0,
+            max_tokens=ROUTER_MAX_TOKENS,
+            **request
+        )
+        
+        # Only the first token is generated; "Y" covers YES however it's split
+        token = answer.strip().upper()
+        use_kg = token.startswith("Y")
+        if token not in ("YES", "NO"):
+            logger.warning("Router answered %r instead of YES/NO for %r; using %s",
+                           answer, question, "KG" if use_kg else "in-memory")
+        logger.info("LLM route %r -> %s", question, "KG" if use_kg else "in-memory")
+        return use_kg
+    
+    @staticmethod
+    def keyword_route(question):
+        """True (KG) or False (in-memory) when keywords decide the route, else None"""
+        is_kg = bool(KG_KEYWORDS_RE.search(question))
+        is_simple = bool(SIMPLE_KEYWORDS_RE.search(question))
+        if is_kg != is_simple:
+            return is_kg
+        return None
+    
+    def should_use_kg(self, question, prefetched=None):
+        """Route a question to the Knowledge Graph or in-memory processing"""
+        
+        route = self.keyword_route(question)
+        if route is True:
+            self._notify('success', "✅ Using Knowledge Graph: comparison/ranking/pattern question")
+            return True
+        if route is False:
+            self._notify('info', "⚡ Using In-Memory: total/lookup question")
+            return False
+        
+        # Paraphrases of earlier (or canonical) questions reuse their route
+        if prefetched is not None:
+            embedding = prefetched['embedding'].result()
+        else:
+            embedding = self._embed_question(question)
+        if embedding is not None:
+            use_kg = self._route_semantic.lookup(embedding)
+            if use_kg is not None:
+                if use_kg:
+                    self._notify('success', "✅ Using Knowledge Graph")
+                else:
+                    self._notify('info', "⚡ Using In-Memory")
+                return use_kg
+        
+        # Case and spacing don't change the routing decision
+        key = " ".join(question.lower().split())
+        
+        try:
+            use_kg = self._route_cached(key)
+            if embedding is not None:
+                self._route_semantic.add(embedding, use_kg)
             
-            response = self.openai.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[
-                    {"role": "system", "content": "You are a Cypher expert for Neo4j. CRITICAL: This graph has User nodes (NOT Account nodes). Relationships are [:MADE_TRANSACTION], [:AT_MERCHANT], [:IN_CATEGORY]. NO [:FROM_ACCOUNT] or [:MADE_AT] relationships exist. Always start queries with (u:User {id: $user_id})-[:MADE_TRANSACTION]->(t:Transaction). Return only valid JSON."},
-                    {"role": "user", "content": cypher_prompt}
-                ],
-                temperature=0,
-                response_format={"type": "json_object"}
-            )
+            if use_kg:
+                self._notify('success', "✅ Using Knowledge Graph")
+            else:
+                self._notify('info', "⚡ Using In-Memory")
             
-            result = json.loads(response.choices[0].message.content)
-            cypher = result.get('cypher')
-            parameters = result.get('parameters', {'user_id': neo4j_user_id})
+            return use_kg
             
-            if not cypher:
-                st.error("No Cypher query generated")
-                return None
+        except Exception as e:
+            self._notify('error', f"❌ Routing failed: {str(e)}")
+            self._notify('warning', "Defaulting to in-memory processing")
+            return False
+    
+    def _generate_cypher_uncached(self, question, currency):
+        """Ask GPT for a Cypher query and its non-user parameters"""
+        
+        for pattern, cypher, to_parameters in self._templates:
+            match = pattern.fullmatch(question)
+            if match:
+                return cypher, to_parameters(match)
+        
+        return self._request_cypher(self._cypher_messages(question, currency))
+    
+    def _mentioned_categories(self, question):
+        """Stored names of the categories a question mentions, in question order"""
+        if self._category_re is None:
+            return []
+        names = [self._category_names[match.group().lower()] for match in self._category_re.finditer(question)]
+        return list(dict.fromkeys(names))
+    
+    def _stored_category_names(self, parameters):
+        """Replace category names the model mis-cased or mis-spaced with the stored ones"""
+        def stored(value):
+            if isinstance(value, str):
+                return self._category_names.get(value.strip().lower(), value)
+            return value
+        
+        return {
+            name: [stored(item) for item in value] if isinstance(value, list) else stored(value)
+            for name, value in parameters.items()
+        }
+    
+    def _cypher_messages(self, question, currency):
+        cypher_prompt = f"""User's Default Currency: {currency}
+Question: "{question}"
+"""
+        categories = self._mentioned_categories(question)
+        if categories:
+            cypher_prompt += f"Categories: {orjson.dumps(categories).decode()}\n"
+        return [
+            {"role": "system", "content": self._cypher_system_prompt},
+            {"role": "user", "content": cypher_prompt}
+        ]
+    
+    @staticmethod
+    def _cypher_request(messages):
+        """Chat request for a Cypher generation conversation"""
+        return {
+            'model': "gpt-4o-mini",
+            'messages': messages,
+            'temperature': 0,
+            'response_format': {"type": "json_schema", "json_schema": CYPHER_RESPONSE_SCHEMA}
+        }
+    
+    def _request_cypher(self, messages):
+        """Run a Cypher generation conversation and parse the JSON answer"""
+        answer = self._llm_cached(**self._cypher_request(messages))
+        
+        result = orjson.loads(answer)
+        if not result['cypher'].strip():
+            # Raised rather than returned so a failed generation is not cached
+            raise ValueError("No Cypher query generated")
+        # JSON numbers may arrive as floats; LIMIT/SKIP only accept integers
+        parameters = {
+            p['name']: int(p['value']) if isinstance(p['value'], float) and p['value'].is_integer() else p['value']
+            for p in result['parameters']
+        }
+        cypher, parameters = canonicalize_cypher(result['cypher'], parameters)
+        return cypher, self._stored_category_names(parameters)
+    
+    def _repair_cypher(self, question, currency, cypher, parameters, error):
+        """Ask GPT once more, showing it the query Neo4j rejected and why"""
+        previous = orjson.dumps({
+            'cypher': cypher,
+            'parameters': [{'name': name, 'value': value} for name, value in parameters.items()]
+        }).decode()
+        messages = self._cypher_messages(self._question_key(question), currency) + [
+            {"role": "assistant", "content": previous},
+            {"role": "user", "content": f"Your previous Cypher failed with: {error}. Fix it."}
+        ]
+        return self._request_cypher(messages)
+    
+    def _explain(self, cypher, parameters):
+        """Plan a query without running it; raises ClientError for invalid Cypher.
+        
+        Schema hallucinations fail here in milliseconds instead of after the
+        database has started executing. Queries that planned before are not
+        planned again.
+        """
+        if cypher in _TEMPLATE_CYPHER or cypher in self._explained_cypher:
+            return
+        
+        summary = self.driver.execute_query(
+            f"EXPLAIN {cypher}",
+            parameters,
+            database_=self.database,
+            routing_=RoutingControl.READ,
+            result_transformer_=lambda result: result.consume()
+        )
+        # Operator names may carry a runtime suffix, e.g. "AllNodesScan@neo4j"
+        plans = [summary.plan] if summary.plan else []
+        while plans:
+            plan = plans.pop()
+            if plan.get('operatorType', '').startswith('AllNodesScan'):
+                self._notify('warning', "⚠️ Query plan scans all nodes; it may be slow")
+                break
+            plans.extend(plan.get('children', []))
+        
+        with self._explained_cypher_lock:
+            if len(self._explained_cypher) >= EXPLAINED_CACHE_SIZE:
+                self._explained_cypher.clear()
+            self._explained_cypher.add(cypher)
+    
+    @staticmethod
+    def _question_key(question):
+        """Cypher cache key for a question"""
+        # Whitespace and trailing punctuation don't change the query; numbers
+        # and names do, so they stay part of the key
+        return " ".join(question.split()).rstrip("?!. ")
+    
+    def _embed_question(self, question):
+        """Embedding for the result cache, or None if the embeddings call fails"""
+        try:
+            return embed_text(self.openai, question.lower().strip())
+        except Exception:
+            return None
+    
+    def prefetch(self, question, currency):
+        """Start the question embedding and Cypher generation while the router decides"""
+        # If the question isn't routed to the KG, the Cypher just stays cached
+        return {
+            'embedding': self._pool.submit(self._embed_question, question),
+            'cypher': self._pool.submit(self._cypher_for_question, question, currency)
+        }
+    
+    def query_kg(self, question, user_id, currency, prefetched=None):
+        """Generate Cypher and query Neo4j with NEW SCHEMA"""
+        
+        neo4j_user_id = UUID_TO_USER_ID.get(user_id, user_id)
+        if prefetched is None:
+            prefetched = self.prefetch(question, currency)
+        
+        # A paraphrase of a recent question reuses its query and results, but
+        # only with the same numbers and categories: "топ 5" and "топ 10"
+        # embed almost identically
+        result_cache = self._result_caches.setdefault(neo4j_user_id, SemanticCache(threshold=KG_SEMANTIC_THRESHOLD))
+        _, slots = self._question_template(question)
+        embedding = prefetched['embedding'].result()
+        if embedding is not None:
+            cached = result_cache.lookup(embedding)
+            if cached and time.monotonic() - cached[0] < KG_RESULT_TTL and cached[1] == slots:
+                self._notify('success', "⚡ Reusing Knowledge Graph results for a similar question")
+                return cached[2]
+        
+        try:
+            self._notify('info', "🔧 Generating Cypher query...")
+            cypher, extra_parameters = prefetched['cypher'].result()
+            parameters = {**extra_parameters, 'user_id': neo4j_user_id}
             
-            st.success(f"✅ Query generated: {cypher[:100]}...")
+            self._notify('success', f"✅ Query generated: {cypher[:100]}...")
             
-            # Execute query
-            with self.driver.session() as session:
-                records = session.run(cypher, parameters)
-                data = [record.data() for record in records]
+            # One row past the cap tells whether the result was cut
+            generated = cypher
+            cypher = with_row_limit(generated)
             
-            st.success(f"✅ Retrieved {len(data)} records from Knowledge Graph")
+            try:
+                self._explain(cypher, parameters)
+            except ClientError as e:
+                # One retry with the error fed back to the generator, which
+                # sees its own query without the row cap added here
+                self._notify('warning', f"⚠️ Neo4j rejected the query, regenerating: {e.message}")
+                try:
+                    generated, extra_parameters = self._repair_cypher(
+                        question, currency, generated, extra_parameters, e.message
+                    )
+                    parameters = {**extra_parameters, 'user_id': neo4j_user_id}
+                    cypher = with_row_limit(generated)
+                    self._explain(cypher, parameters)
+                except Exception:
+                    # Don't keep answering this question with a query that fails
+                    self._forget_cypher(question, currency)
+                    raise
+                # Later questions of this shape get the repaired query directly
+                self._remember_cypher(question, currency, generated, extra_parameters)
             
-            return {
+            # execute_query manages the session and retries transient errors;
+            # READ routing sends it to a reader on clusters. Only the first
+            # KG_MAX_ROWS records (plus one to detect more) are read off the cursor
+            data = self.driver.execute_query(
+                cypher,
+                parameters,
+                database_=self.database,
+                routing_=RoutingControl.READ,
+                result_transformer_=lambda result: [
+                    record.data() for record in itertools.islice(result, KG_MAX_ROWS + 1)
+                ]
+            )
+            truncated = len(data) > KG_MAX_ROWS
+            data = data[:KG_MAX_ROWS]
+            
+            self._notify('success', f"✅ Retrieved {len(data)} records from Knowledge Graph")
+            
+            kg_data = {
                 'source': 'kg',
                 'cypher': cypher,
                 'results': data,
+                'truncated': truncated,
                 'parameters': parameters
             }
+            if embedding is not None:
+                result_cache.add(embedding, (time.monotonic(), slots, kg_data))
+            return kg_data
             
         except Exception as e:
-            st.error(f"❌ KG query failed: {str(e)}")
-            import traceback
-            st.code(traceback.format_exc())
+            logger.exception("KG query failed")
+            if self.verbose:
+                st.error(f"❌ KG query failed: {str(e)}")
+            return None
+    
+    def _template_format(self, kg_data, language, currency):
+        """Phrase small, purely tabular results directly; None if the LLM is needed"""
+        
+        results = kg_data['results']
+        if len(results) > TEMPLATE_MAX_ROWS or language not in TEMPLATE_HEADERS:
+            return None
+        
+        labels = TEMPLATE_COLUMN_LABELS[language]
+        
+        def format_label(column):
+            if column in labels:
+                return labels[column]
+            if language == 'ENG':
+                return column.replace('_', ' ')
+            return None
+        
+        def format_value(column, value):
+            if isinstance(value, bool) or value is None:
+                return None
+            if isinstance(value, (int, float)):
+                name = column.lower()
+                if any(hint in name for hint in COUNT_COLUMN_HINTS):
+                    return f"{value:,.0f}"
+                if any(hint in name for hint in AMOUNT_COLUMN_HINTS):
+                    return f"{value:,.2f} {currency}"
+                # Years, ranks and other plain integers; unknown measures need the LLM
+                if isinstance(value, int):
+                    return str(value)
+                return None
+            if isinstance(value, str) and len(value) <= TEMPLATE_MAX_TEXT:
+                return value
             return None
+        
+        rows = []
+        for record in results:
+            row = [(format_label(column), format_value(column, value)) for column, value in record.items()]
+            if not row or any(label is None or value is None for label, value in row):
+                return None
+            rows.append(row)
+        
+        header = TEMPLATE_HEADERS[language]
+        if len(rows) == 1:
+            lines = [f"- {column}: **{value}**" for column, value in rows[0]]
+        else:
+            # Rows lead with their label column (merchant, category, ...) when there is one
+            has_label = isinstance(next(iter(results[0].values())), str)
+            lines = []
+            for number, row in enumerate(rows, 1):
+                if has_label:
+                    details = ", ".join(f"{column}: {value}" for column, value in row[1:])
+                    lines.append(f"{number}. **{row[0][1]}**" + (f" — {details}" if details else ""))
+                else:
+                    lines.append(f"{number}. " + ", ".join(f"{column}: {value}" for column, value in row))
+        return "\n".join([header, ""] + lines)
+    
+    @staticmethod
+    def _is_homogeneous(results):
+        """True if every row has the same columns and only primitive values"""
+        columns = results[0].keys()
+        return all(
+            record.keys() == columns
+            and all(value is None or isinstance(value, (str, int, float)) for value in record.values())
+            for record in results
+        )
+    
+    def _stream_answer(self, deltas, fallback):
+        """Yield the text deltas of a streamed formatter reply"""
+        try:
+            yield from deltas
+        except Exception as e:
+            self._notify('error', f"Formatting failed: {e}")
+            yield fallback
     
     def format_kg_results(self, kg_data, question, language, currency):
-        """Convert KG results to natural language"""
+        """Convert KG results to natural language, as a string or a stream of text deltas"""
         
         if not kg_data or not kg_data.get('results'):
             return "Данные не найдены." if language == 'RUS' else "No data found."
         
-        format_prompt = f"""Convert query results to a natural answer.
-
-Question: {question}
-Results: {json.dumps(kg_data['results'], ensure_ascii=False, indent=2)}
-Language: {language}
+        templated = self._template_format(kg_data, language, currency)
+        if templated:
+            return templated
+        
+        # The formatter only needs a preview of large results
+        results = kg_data['results']
+        payload = {
+            'rows': results[:FORMAT_MAX_ROWS],
+            'rows_returned': len(results),
+            'truncated': kg_data.get('truncated', False)
+        }
+        if len(results) > FORMAT_MAX_ROWS:
+            # Overall figures would otherwise need the rows that were cut;
+            # nulls (e.g. a sum over no transactions) count as zero
+            payload['column_totals'] = {
+                column: round(sum(record.get(column) or 0 for record in results), 2)
+                for column in results[0]
+                if any(hint in column.lower() for hint in ADDITIVE_COLUMN_HINTS)
+                and not any(hint in column.lower() for hint in NON_ADDITIVE_COLUMN_HINTS)
+                and all(
+                    record.get(column) is None
+                    or isinstance(record.get(column), (int, float)) and not isinstance(record.get(column), bool)
+                    for record in results
+                )
+                and any(record.get(column) is not None for record in results)
+            }
+        
+        format_prompt = f"""Language: {language}
 Currency: {currency}
-
-Instructions:
-- Be conversational and clear
-- Format numbers with proper currency symbols
-- Use the user's language
-- Keep it concise but informative
-
-Provide ONLY the answer, no additional commentary.
+Question: {question}
+Results: {orjson.dumps(payload, default=str).decode()}
 """
         
+        # Regular tables are simple enough for the cheaper formatter model
+        client, model = None, "gpt-4o-mini"
+        if self.formatter_client is not None and self._is_homogeneous(results):
+            client, model = self.formatter_client, self.formatter_model
+        
         try:
-            response = self.openai.chat.completions.create(
-                model="gpt-4o-mini",
+            answer = self._llm_cached(
+                client=client,
+                model=model,
                 messages=[
-                    {"role": "system", "content": "You are a helpful financial assistant."},
+                    {"role": "system", "content": FORMAT_SYSTEM_PROMPT},
                     {"role": "user", "content": format_prompt}
                 ],
-                temperature=0.3
+                temperature=0.3,
+                max_tokens=FORMAT_MAX_TOKENS,
+                stream=True
             )
-            return response.choices[0].message.content.strip()
+            if isinstance(answer, str):
+                return answer
+            return self._stream_answer(answer, str(kg_data['results']))
         except Exception as e:
-            st.error(f"Formatting failed: {e}")
-            return str(kg_data['results'])
\ No newline at end of file
+            self._notify('error', f"Formatting failed: {e}")
+            return str(kg_data['results'])
+
+
+@st.cache_resource(show_spinner=False)
+def get_kg_helper(uri, user, password, openai_api_key, database="neo4j",
+                  formatter_base_url=None, formatter_model=None, formatter_api_key=None, verbose=False,
+                  numeric_amounts=False):
+    """Shared SimpleKGHelper for the process; use this instead of the constructor.
+    
+    Streamlit reruns the script on every interaction, so a helper built in
+    the script would redo the Bolt and TLS handshakes each time. The driver
+    is closed at interpreter exit, not on rerun. Chat completions and
+    embeddings share one HTTP/2 connection pool to the OpenAI API when
+    httpx with HTTP/2 support is installed, else the default OpenAI client.
+    Pass numeric_amounts=True once migrate_amounts.py has run on the graph.
+    """
+    http_client = None
+    try:
+        import httpx
+        http_client = httpx.Client(
+            http2=True,
+            limits=httpx.Limits(max_connections=64, max_keepalive_connections=32),
+            timeout=30.0
+        )
+    except ImportError as e:
+        logger.warning("Using the default OpenAI HTTP client: %s", e)
+    formatter_client = None
+    if formatter_base_url and formatter_model:
+        formatter_client = OpenAI(base_url=formatter_base_url, api_key=formatter_api_key or "ollama")
+    helper = SimpleKGHelper(
+        uri, user, password, OpenAI(api_key=openai_api_key, http_client=http_client),
+        database=database,
+        formatter_client=formatter_client,
+        formatter_model=formatter_model,
+        verbose=verbose,
+        numeric_amounts=numeric_amounts
+    )
+    atexit.register(helper.close)
+    if http_client is not None:
+        atexit.register(http_client.close)
+    return helper
@@ -0,0 +1,59 @@
+import unittest
+
+import numpy as np
+
+from semantic_cache import SemanticCache
+from simple_kg_helper import category_matcher, question_template
+
+
+def unit(vector):
+    vector = np.asarray(vector, dtype=np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+class SemanticAnswerCacheTest(unittest.TestCase):
+    """Similar questions share cached answers only when their slots match"""
+
+    def setUp(self):
+        self.cache = SemanticCache(threshold=0.95)
+        self.category_re, self.category_names = category_matcher(['Продукты', 'Такси '])
+        # Questions differing only in a value embed almost identically
+        self.embedding = unit([1.0, 0.2, 0.1])
+        self.paraphrase = unit([1.0, 0.21, 0.1])
+
+    def slots(self, question):
+        return question_template(question, self.category_re, self.category_names)[1]
+
+    def store(self, question, answer):
+        self.cache.add(self.embedding, answer, self.slots(question))
+
+    def lookup(self, question):
+        return self.cache.lookup(self.paraphrase, self.slots(question))
+
+    def test_different_number_is_not_served(self):
+        self.store("Top 5 merchants by spending", "five")
+        self.assertIsNone(self.lookup("top 10 merchants by spending"))
+
+    def test_different_month_is_not_served(self):
+        self.store("How much did I spend in March?", "march")
+        self.assertIsNone(self.lookup("How much did I spend in April?"))
+        self.assertIsNone(self.lookup("Сколько я потратил в апреле?"))
+
+    def test_different_category_is_not_served(self):
+        self.store("Сколько я потратил на продукты?", "groceries")
+        self.assertIsNone(self.lookup("Сколько я потратил на такси?"))
+
+    def test_same_slots_are_served(self):
+        self.store("Top 5 merchants by spending", "five")
+        self.store("How much did I spend in March?", "march")
+        self.assertEqual(self.lookup("My top 5 merchants by spending"), "five")
+        self.assertEqual(self.lookup("How much did I spend in mar"), "march")
+
+    def test_matching_entry_wins_over_a_closer_one(self):
+        self.store("top 5 merchants", "five")
+        self.cache.add(self.paraphrase, "ten", self.slots("top 10 merchants"))
+        self.assertEqual(self.lookup("top 5 merchants"), "five")
+
+
+if __name__ == '__main__':
+    unittest.main()